@@ -0,0 +1,288 @@
+import itertools
+
+import numpy as np
+
+from semi_global_alignment import PAM250, GAP_PENALTY
+from vectorized_fill import DIAGONAL, HORIZONTAL, VERTICAL, scoring_to_array, encode, fill_rows
+
+MOVES = ((DIAGONAL, -1, -1), (HORIZONTAL, 0, -1), (VERTICAL, -1, 0))
+
+# Traceback bits of the affine/banded engine: which state H came from, whether P = max(M, Y)
+# came from Y, and whether the X (horizontal) and Y (vertical) gap states were extended
+STATE_M = 0
+STATE_X = 1
+STATE_Y = 2
+H_STATE = 3
+P_FROM_Y = 4
+X_EXTENDED = 8
+Y_EXTENDED = 16
+
+
+# Re-entrant semi-global aligner: all per-alignment state lives in local variables,
+# so a single instance can be shared between calls and threads.
+class Aligner:
+    # gap_open/gap_extend switch to affine gaps (a gap of length L costs gap_open + (L - 1) * gap_extend)
+    # and band limits the fill to diagonals within band of the main one, widened while the best
+    # path in the band touches its edge (an optimum that never comes near the band can be missed,
+    # as with any band). Both of these modes return a single optimal alignment.
+    def __init__(self, scoring=PAM250, gap_penalty=GAP_PENALTY, gap_open=None, gap_extend=None, band=None):
+        self.codes, self.scoring = scoring_to_array(scoring)
+        self.gap_penalty = gap_penalty
+        self.gap_open = gap_penalty if gap_open is None else gap_open
+        self.gap_extend = gap_penalty if gap_extend is None else gap_extend
+        self.band = band
+
+    def single_optimum(self):
+        return self.band is not None or self.gap_open != self.gap_extend
+
+    # Direction bitmask (uint8, one byte per cell) plus the last row and column of scores,
+    # which is all the traceback needs
+    def fill(self, a, b):
+        seq1 = encode(a, self.codes)
+        seq2 = encode(b, self.codes)
+
+        directions = np.zeros((len(a) + 1, len(b) + 1), dtype=np.uint8)
+        last_column = np.zeros(len(a) + 1, dtype=np.int32)
+        last_row = np.zeros(len(b) + 1, dtype=np.int32)
+
+        for i, (row, row_directions) in enumerate(fill_rows(seq1, seq2, self.scoring, self.gap_open), 1):
+            directions[i] = row_directions
+            last_column[i] = row[-1]
+            last_row = row
+
+        return directions, last_row, last_column
+
+    @staticmethod
+    def end_locations(last_row, last_column):
+        n, m = len(last_column) - 1, len(last_row) - 1
+
+        total_score = 0
+        if n and m:
+            total_score = max(0, int(last_row[1:].max()), int(last_column[1:].max()))
+
+        locations = [(i, m) for i in range(n) if last_column[i] >= total_score]
+        locations += [(n, j) for j in range(m + 1) if last_row[j] >= total_score]
+        return total_score, locations
+
+    def score(self, a, b):
+        if self.single_optimum():
+            return self.align_banded(a, b)[0]
+
+        _, last_row, last_column = self.fill(a, b)
+        total_score, _ = self.end_locations(last_row, last_column)
+        return total_score
+
+    def align(self, a, b, max_alignments=None):
+        if self.single_optimum():
+            total_score, alignment = self.align_banded(a, b)
+            return total_score, [alignment][:max_alignments]
+
+        directions, last_row, last_column = self.fill(a, b)
+        total_score, locations = self.end_locations(last_row, last_column)
+        alignments = (alignment for x, y in locations for alignment in self.trace_back(a, b, directions, x, y))
+        alignments = list(itertools.islice(alignments, max_alignments))
+        # Only the all-gap alignment scores total_score (0), e.g. for empty input; the banded and
+        # affine modes return it too
+        if not alignments and max_alignments != 0:
+            alignments = [(a + '-' * len(b), '-' * len(a) + b)]
+        return total_score, alignments
+
+    def count(self, a, b):
+        if self.single_optimum():
+            raise ValueError('co-optimal alignments are only counted for linear gaps without a band')
+
+        directions, last_row, last_column = self.fill(a, b)
+        total_score, locations = self.end_locations(last_row, last_column)
+        paths = self.count_paths(directions)
+        # The all-gap alignment counts when nothing else reaches total_score, as in align
+        return total_score, sum(paths[x][y] for x, y in locations if x and y) or 1
+
+    @staticmethod
+    def count_paths(directions):
+        n, m = directions.shape
+        paths = [[1] * m for _ in range(n)]
+
+        for i in range(1, n):
+            cells = directions[i].tolist()
+            for j in range(1, m):
+                total = 0
+                for bit, dx, dy in MOVES:
+                    if cells[j] & bit:
+                        total += paths[i + dx][j + dy]
+                paths[i][j] = total
+        return paths
+
+    # Same explicit stack traceback as semi_global_alignment.trace_back, over the bitmask
+    @staticmethod
+    def trace_back(a, b, directions, x, y):
+        tail1 = a[x:] + '-' * (len(b) - y)
+        tail2 = '-' * (len(a) - x) + b[y:]
+        path1 = []
+        path2 = []
+        stack = [(x, y, 0)]
+
+        while stack:
+            i, j, k = stack.pop()
+            del path1[len(stack):]
+            del path2[len(stack):]
+
+            if i == 0 or j == 0:
+                if stack:
+                    yield ('-' * j + a[:i] + ''.join(reversed(path1)) + tail1,
+                           b[:j] + '-' * i + ''.join(reversed(path2)) + tail2)
+                continue
+
+            cell = int(directions[i, j])
+            while k < len(MOVES) and not cell & MOVES[k][0]:
+                k += 1
+            if k == len(MOVES):
+                continue
+            stack.append((i, j, k + 1))
+
+            bit, dx, dy = MOVES[k]
+            path1.append('-' if bit == HORIZONTAL else a[i - 1])
+            path2.append('-' if bit == VERTICAL else b[j - 1])
+            stack.append((i + dx, j + dy, 0))
+
+    def align_banded(self, a, b):
+        seq1 = encode(a, self.codes)
+        seq2 = encode(b, self.codes)
+        n, m = len(seq1), len(seq2)
+
+        if self.band is None:
+            lower, upper = -n, m
+        else:
+            lower, upper = min(0, m - n) - self.band, max(0, m - n) + self.band
+
+        while True:
+            lower, upper = max(lower, -n), min(upper, m)
+            bits, end_scores = fill_band(seq1, seq2, self.scoring, self.gap_open, self.gap_extend, lower, upper)
+            total_score, alignment, touched = trace_band(a, b, bits, end_scores, lower, upper)
+
+            # The optimum ran along the edge of the band, so a better path may lie outside it
+            if not touched:
+                return total_score, alignment
+            width = max(upper - lower, 1)
+            lower, upper = lower - width, upper + width
+
+
+# Affine-gap semi-global fill restricted to the diagonals lower <= j - i <= upper (Gotoh).
+# Rows are stored in diagonal coordinates, t = j - i - lower, so the diagonal neighbour of a cell
+# has the same offset in the previous row, the vertical one offset t + 1 and the horizontal one t - 1.
+# Returns the traceback bits and the H scores of the last row and last column (as {cell: score}).
+# The full matrix is the band lower=-n, upper=m, which costs about twice an unbanded fill.
+def fill_band(seq1, seq2, scoring, gap_open, gap_extend, lower, upper):
+    n, m = len(seq1), len(seq2)
+    width = upper - lower + 1
+    offsets = np.arange(width)
+
+    bits = np.zeros((n + 1, width), dtype=np.uint8)
+    end_scores = {}
+
+    columns = lower + offsets
+    h_prev = np.where((columns >= 0) & (columns <= m), 0.0, -np.inf)
+    y_prev = np.full(width, -np.inf)
+    x_gaps = gap_extend * offsets
+
+    for i in range(1, n + 1):
+        columns = i + lower + offsets
+        inside = (columns >= 1) & (columns <= m)
+        border = columns == 0
+
+        substitution = scoring[seq1[i - 1]][seq2[np.clip(columns - 1, 0, max(m - 1, 0))]] if m else 0
+        match = np.where(inside, h_prev + substitution, -np.inf)
+
+        h_up = np.append(h_prev[1:], -np.inf)
+        y_up = np.append(y_prev[1:], -np.inf)
+        y_open = h_up + gap_open
+        y_extend = y_up + gap_extend
+        vertical = np.where(inside, np.maximum(y_open, y_extend), -np.inf)
+
+        p_row = np.maximum(match, vertical)
+        p_row[border] = 0
+
+        # X[t] = max(P[t - 1] + open, X[t - 1] + extend), unrolled with a prefix maximum
+        opened = np.maximum.accumulate(p_row + gap_open - gap_extend - x_gaps)
+        horizontal = np.full(width, -np.inf)
+        horizontal[1:] = opened[:-1] + x_gaps[1:]
+        horizontal[~inside] = -np.inf
+        x_open = np.full(width, -np.inf)
+        x_open[1:] = p_row[:-1] + gap_open
+
+        h_row = np.maximum(match, np.maximum(horizontal, vertical))
+        h_row[border] = 0
+
+        state = np.where(h_row == match, STATE_M, np.where(h_row == horizontal, STATE_X, STATE_Y))
+        row_bits = state.astype(np.uint8)
+        row_bits |= (vertical > match) * np.uint8(P_FROM_Y)
+        row_bits |= (horizontal > x_open) * np.uint8(X_EXTENDED)
+        row_bits |= (y_extend > y_open) * np.uint8(Y_EXTENDED)
+        bits[i] = row_bits
+
+        if lower <= m - i <= upper and m:
+            end_scores[(i, m)] = h_row[m - i - lower]
+        h_prev = h_row
+        y_prev = vertical
+
+    if n:
+        for t in offsets[inside]:
+            end_scores[(n, n + lower + t)] = h_prev[t]
+
+    return bits, end_scores
+
+
+def trace_band(a, b, bits, end_scores, lower, upper):
+    n, m = len(a), len(b)
+    width = upper - lower + 1
+
+    # Same end cell order as find_total_score_locations: last column top-down, then last row
+    cells = sorted(end_scores)
+    # Only the empty alignment scores 0 or more, and it lies outside any band short of the full matrix
+    if not cells or max(end_scores.values()) < 0:
+        return 0, (a + '-' * m, '-' * n + b), lower > -n or upper < m
+
+    total_score = max(end_scores.values())
+    end = next(cell for cell in cells if end_scores[cell] == total_score)
+    total_score = int(total_score)
+
+    x, y = end
+    path1 = []
+    path2 = []
+    touched = False
+    i, j = x, y
+    state = bits[i, j - i - lower] & H_STATE
+
+    # Whether the path goes through a cell on an edge diagonal that is not the matrix edge
+    def on_edge(i, j):
+        t = j - i - lower
+        return (t == 0 and lower > -n) or (t == width - 1 and upper < m)
+
+    while i > 0 and j > 0:
+        t = j - i - lower
+        touched = touched or on_edge(i, j)
+        cell = bits[i, t]
+
+        if state == STATE_M:
+            path1.append(a[i - 1])
+            path2.append(b[j - 1])
+            i, j = i - 1, j - 1
+            if i and j:
+                state = bits[i, t] & H_STATE
+        elif state == STATE_X:
+            path1.append('-')
+            path2.append(b[j - 1])
+            j -= 1
+            if j and not cell & X_EXTENDED:
+                state = STATE_Y if bits[i, t - 1] & P_FROM_Y else STATE_M
+        else:
+            path1.append(a[i - 1])
+            path2.append('-')
+            i -= 1
+            if i and not cell & Y_EXTENDED:
+                state = bits[i, t + 1] & H_STATE
+
+    # The border cell the path starts from (or the end cell itself, when it is on the border)
+    touched = touched or on_edge(i, j)
+    aligned1 = '-' * j + a[:i] + ''.join(reversed(path1)) + a[x:] + '-' * (m - y)
+    aligned2 = b[:j] + '-' * i + ''.join(reversed(path2)) + '-' * (n - x) + b[y:]
+    return total_score, (aligned1, aligned2), touched
@@ -0,0 +1,145 @@
+import argparse
+
+from semi_global_alignment import PAM250, GAP_PENALTY
+
+
+# Last row of the global (Needleman-Wunsch) score matrix of a against b, in O(len(b)) memory
+def global_last_row(a, b, scoring=PAM250, gap_penalty=GAP_PENALTY):
+    prev_row = [j * gap_penalty for j in range(len(b) + 1)]
+
+    for i in range(1, len(a) + 1):
+        scores = scoring[a[i - 1]]
+        row = [i * gap_penalty]
+        for j in range(1, len(b) + 1):
+            row.append(max(prev_row[j - 1] + scores[b[j - 1]],
+                           row[j - 1] + gap_penalty,
+                           prev_row[j] + gap_penalty))
+        prev_row = row
+
+    return prev_row
+
+
+# Global alignment of a and b in linear memory (Hirschberg divide and conquer)
+def hirschberg(a, b, scoring=PAM250, gap_penalty=GAP_PENALTY):
+    if len(a) == 0:
+        return '-' * len(b), b
+    if len(b) == 0:
+        return a, '-' * len(a)
+    if len(a) == 1 or len(b) == 1:
+        return small_global_align(a, b, scoring, gap_penalty)
+
+    mid = len(a) // 2
+    upper = global_last_row(a[:mid], b, scoring, gap_penalty)
+    lower = global_last_row(a[mid:][::-1], b[::-1], scoring, gap_penalty)
+
+    split = 0
+    best = float('-inf')
+    for j in range(len(b) + 1):
+        score = upper[j] + lower[len(b) - j]
+        if score > best:
+            best = score
+            split = j
+
+    left1, left2 = hirschberg(a[:mid], b[:split], scoring, gap_penalty)
+    right1, right2 = hirschberg(a[mid:], b[split:], scoring, gap_penalty)
+    return left1 + right1, left2 + right2
+
+
+# Full-matrix global alignment, only used for the base case where one side has a single residue
+def small_global_align(a, b, scoring=PAM250, gap_penalty=GAP_PENALTY):
+    matrix = [[j * gap_penalty for j in range(len(b) + 1)]]
+    for i in range(1, len(a) + 1):
+        row = [i * gap_penalty]
+        for j in range(1, len(b) + 1):
+            row.append(max(matrix[i - 1][j - 1] + scoring[a[i - 1]][b[j - 1]],
+                           row[j - 1] + gap_penalty,
+                           matrix[i - 1][j] + gap_penalty))
+        matrix.append(row)
+
+    aligned1 = ''
+    aligned2 = ''
+    i, j = len(a), len(b)
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and matrix[i][j] == matrix[i - 1][j - 1] + scoring[a[i - 1]][b[j - 1]]:
+            aligned1 = a[i - 1] + aligned1
+            aligned2 = b[j - 1] + aligned2
+            i -= 1
+            j -= 1
+        elif j > 0 and matrix[i][j] == matrix[i][j - 1] + gap_penalty:
+            aligned1 = '-' + aligned1
+            aligned2 = b[j - 1] + aligned2
+            j -= 1
+        else:
+            aligned1 = a[i - 1] + aligned1
+            aligned2 = '-' + aligned2
+            i -= 1
+
+    return aligned1, aligned2
+
+
+# Semi-global score-only pass: free leading gaps, best cell in the last row or column.
+# With free_start=False the first row and column are charged instead (used for the reverse pass).
+def semi_global_end(a, b, scoring=PAM250, gap_penalty=GAP_PENALTY, free_start=True):
+    start_penalty = 0 if free_start else gap_penalty
+    prev_row = [j * start_penalty for j in range(len(b) + 1)]
+
+    best_score = prev_row[len(b)]
+    best_cell = (0, len(b))
+
+    for i in range(1, len(a) + 1):
+        scores = scoring[a[i - 1]]
+        row = [i * start_penalty]
+        for j in range(1, len(b) + 1):
+            row.append(max(prev_row[j - 1] + scores[b[j - 1]],
+                           row[j - 1] + gap_penalty,
+                           prev_row[j] + gap_penalty))
+
+        if row[len(b)] >= best_score:
+            best_score = row[len(b)]
+            best_cell = (i, len(b))
+        prev_row = row
+
+    for j in range(len(b) + 1):
+        if prev_row[j] >= best_score:
+            best_score = prev_row[j]
+            best_cell = (len(a), j)
+
+    return best_score, best_cell
+
+
+def semi_global_score(a, b, scoring=PAM250, gap_penalty=GAP_PENALTY):
+    score, _ = semi_global_end(a, b, scoring, gap_penalty)
+    return score
+
+
+# One optimal semi-global alignment using memory linear in the sequence lengths
+def linear_semi_global_alignment(a, b, scoring=PAM250, gap_penalty=GAP_PENALTY):
+    score, (end1, end2) = semi_global_end(a, b, scoring, gap_penalty)
+
+    # The alignment must start on the first row or column, so run the reversed prefixes
+    # from the fixed end cell and let the reverse pass finish freely on the last row/column
+    _, (rev1, rev2) = semi_global_end(a[:end1][::-1], b[:end2][::-1], scoring, gap_penalty, free_start=False)
+    start1, start2 = end1 - rev1, end2 - rev2
+
+    core1, core2 = hirschberg(a[start1:end1], b[start2:end2], scoring, gap_penalty)
+
+    aligned1 = '-' * start2 + a[:start1] + core1 + a[end1:] + '-' * (len(b) - end2)
+    aligned2 = b[:start2] + '-' * start1 + core2 + '-' * (len(a) - end1) + b[end2:]
+    return score, (aligned1, aligned2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Linear memory semi-global alignment (PAM250)')
+    parser.add_argument('--score-only', action='store_true', help='print only the optimal score')
+    args = parser.parse_args()
+
+    str1 = input()
+    str2 = input()
+
+    if args.score_only:
+        print(semi_global_score(str1, str2))
+    else:
+        total_score, alignment = linear_semi_global_alignment(str1, str2)
+        print(total_score)
+        print(alignment[0])
+        print(alignment[1])
@@ -1,3 +1,9 @@
+import argparse
+import itertools
+
+import shared_path
+import instrument
+
 PAM250 = {
     'A': {'A': 2, 'C': -2, 'D': 0, 'E': 0, 'F': -3, 'G': 1, 'H': -1, 'I': -1, 'K': -1, 'L': -2, 'M': -1, 'N': 0, 'P': 1,
           'Q': 0, 'R': -2, 'S': 1, 'T': 1, 'V': 0, 'W': -6, 'Y': -3},
@@ -45,79 +51,82 @@ score_matrix = []
 direction_matrix = []
 total_score = 0
 total_locations = []
-seq = []
 
 
-def print_output(score, seq):
+def print_output(score, seq, sort=True):
     print(score)
-    sorted_seq = [i[0] + i[1] for i in seq]
-    sorted_seq.sort()
-    for i in sorted_seq:
-        print(i[0:int(len(i) / 2)])
-        print(i[int(len(i) / 2):])
-
-
-def trace_back(strings, x, y):
-    directions = direction_matrix[x][y]
-
-    for direction in directions:
-        next_cell = ()
-        if direction == 'd':
-            next_cell = (x - 1, y - 1)
-        if direction == 'h':
-            next_cell = (x, y - 1)
-        if direction == 'v':
-            next_cell = (x - 1, y)
-
-        if next_cell[0] == 0 or next_cell[1] == 0:
-            string1 = strings[0]
-            string2 = strings[1]
-
-            # TODO add gaps to start of strings if needed
-            for i in range(x - 2, -1, -1):
-                string1 = string1 + str1[i]
-                string2 = string2 + '-'
-            for i in range(y - 2, -1, -1):
-                string1 = string1 + '-'
-                string2 = string2 + str2[i]
-
-            string1 = string1[::-1]
-            string2 = string2[::-1]
-
-            seq.append((string1, string2))
+    if sort:
+        sorted_seq = [i[0] + i[1] for i in seq]
+        sorted_seq.sort()
+        for i in sorted_seq:
+            print(i[0:int(len(i) / 2)])
+            print(i[int(len(i) / 2):])
+    else:
+        for string1, string2 in seq:
+            print(string1)
+            print(string2)
+
+
+def next_cell(direction, x, y):
+    if direction == 'd':
+        return x - 1, y - 1
+    if direction == 'h':
+        return x, y - 1
+    return x - 1, y
+
+
+# Yields every co-optimal alignment ending in cell (x, y), depth first with an explicit stack.
+# Each stack frame is (row, column, index of the next direction to try); the aligned columns
+# chosen so far are kept in path1/path2 (end to start) and only joined when a path is complete.
+def trace_back(x, y):
+    tail1 = str1[x:] + '-' * (len(str2) - y)
+    tail2 = '-' * (len(str1) - x) + str2[y:]
+    path1 = []
+    path2 = []
+    stack = [(x, y, 0)]
+
+    while stack:
+        i, j, k = stack.pop()
+        del path1[len(stack):]
+        del path2[len(stack):]
+
+        directions = direction_matrix[i][j]
+        if k >= len(directions):
+            continue
+        stack.append((i, j, k + 1))
+
+        direction = directions[k]
+        next_x, next_y = next_cell(direction, i, j)
+
+        if next_x == 0 or next_y == 0:
+            string1 = '-' * (j - 1) + str1[:i] + ''.join(reversed(path1)) + tail1
+            string2 = str2[:j - 1] + '-' * (i - 1) + str2[j - 1] + ''.join(reversed(path2)) + tail2
+            yield string1, string2
         else:
-            if direction == 'd':
-                new_string1 = strings[0] + str1[next_cell[0] - 1]
-                new_string2 = strings[1] + str2[next_cell[1] - 1]
-                trace_back((new_string1, new_string2), x - 1, y - 1)
-            elif direction == 'h':
-                new_string1 = strings[0][:-1] + '-' + str1[next_cell[0] - 1]
-                new_string2 = strings[1] + str2[next_cell[1] - 1]
-                trace_back((new_string1, new_string2), x, y - 1)
-            elif direction == 'v':
-                new_string1 = strings[0] + str1[next_cell[0] - 1]
-                new_string2 = strings[1][:-1] + '-' + str2[next_cell[1] - 1]
+            path1.append('-' if direction == 'h' else str1[i - 1])
+            path2.append('-' if direction == 'v' else str2[j - 1])
+            stack.append((next_x, next_y, 0))
 
-                trace_back((new_string1, new_string2), x - 1, y)
 
-    return
+def semi_global_alignment(max_alignments=None):
+    alignments = (alignment for loc in total_locations for alignment in trace_back(loc[0], loc[1]))
+    return itertools.islice(alignments, max_alignments)
 
 
-def semi_global_alignment():
-    for loc in total_locations:
-        x, y = loc[0], loc[1]
-        string1 = '' + str1[x - 1]
-        string2 = '' + str2[y - 1]
+# Number of co-optimal alignments, counted over the direction matrix without building any of them
+def count_alignments():
+    paths = [[0] * (len(str2) + 1) for _ in range(len(str1) + 1)]
 
-        # TODO add gaps to start of strings if needed
-        for i in range(x, len(str1)):
-            string1 = str1[i] + string1
-            string2 = '-' + string2
-        for i in range(y, len(str2)):
-            string1 = '-' + string1
-            string2 = str2[i] + string2
+    for i in range(1, len(str1) + 1):
+        for j in range(1, len(str2) + 1):
+            for direction in direction_matrix[i][j]:
+                next_x, next_y = next_cell(direction, i, j)
+                if next_x == 0 or next_y == 0:
+                    paths[i][j] += 1
+                else:
+                    paths[i][j] += paths[next_x][next_y]
 
-        trace_back((string1, string2), x, y)
+    return sum(paths[loc[0]][loc[1]] for loc in total_locations)
 
 
 # Find cells with total score
@@ -168,8 +177,8 @@ def init_and_fill_matrix():
         for j in range(len(str2) + 1):
             score, direction = calculate_score(score_matrix, i, j)
 
-            score_matrix[score_matrix.index(temp_score_arr)].append(score)
-            direction_matrix[direction_matrix.index(temp_direction_arr)].append(direction)
+            temp_score_arr.append(score)
+            temp_direction_arr.append(direction)
 
     # for i in range(len(str1) + 1):
     #     if i == 0:
@@ -182,7 +191,30 @@ def init_and_fill_matrix():
     #     print(direction_matrix[i])
 
 
+# Same matrices as init_and_fill_matrix, filled a row at a time by the NumPy engine in
+# vectorized_fill (which imports this module, so it is only loaded when asked for) and then
+# converted to the lists and direction strings the traceback reads
+def fill_matrix_vectorized():
+    global score_matrix, direction_matrix, total_score
+    from vectorized_fill import fill_matrices, direction_strings
+
+    scores, directions, total_score = fill_matrices(str1, str2)
+    score_matrix = scores.tolist()
+    direction_matrix = direction_strings(directions)
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Semi-global alignment with PAM250')
+    parser.add_argument('--max-alignments', type=int, default=None, help='print at most this many alignments')
+    parser.add_argument('--stream', action='store_true', help='print alignments as they are found, unsorted')
+    parser.add_argument('--count', action='store_true', help='print the number of co-optimal alignments only')
+    parser.add_argument('--vectorized', action='store_true', help='fill the matrices with the NumPy engine')
+    parser.add_argument('--stats', nargs='?', const='-', metavar='FILE',
+                        help='write stage timings and counts as JSON to FILE (stderr if no FILE is given)')
+    args = parser.parse_args()
+    if args.stats:
+        instrument.enable()
+
     str1 = input()
     str2 = input()
 
@@ -191,9 +223,26 @@ if __name__ == '__main__':
     # str1 = 'AAAAA'
     # str2 = 'AA'
 
-    init_and_fill_matrix()
-    find_total_score_locations()
-    semi_global_alignment()
-
-    # print(seq)
-    print_output(total_score, seq)
+    with instrument.stage('fill'):
+        if args.vectorized:
+            fill_matrix_vectorized()
+        else:
+            init_and_fill_matrix()
+        instrument.count('cells', len(str1) * len(str2))
+    with instrument.stage('find_locations'):
+        find_total_score_locations()
+
+    if args.count:
+        with instrument.stage('count_alignments'):
+            co_optimal = count_alignments()
+        instrument.record('co_optimal_alignments', co_optimal)
+        print(total_score)
+        print(co_optimal)
+    else:
+        with instrument.stage('trace_back'):
+            alignments = instrument.counted(semi_global_alignment(args.max_alignments), 'alignments')
+            print_output(total_score, alignments, sort=not args.stream)
+
+    instrument.record('score', total_score)
+    instrument.record('end_cells', len(total_locations))
+    instrument.emit(args.stats)
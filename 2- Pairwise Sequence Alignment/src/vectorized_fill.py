@@ -0,0 +1,77 @@
+import numpy as np
+
+from semi_global_alignment import PAM250, GAP_PENALTY
+
+# Direction bits, one per letter of the direction strings in semi_global_alignment ('d', 'h', 'v')
+DIAGONAL = 1
+HORIZONTAL = 2
+VERTICAL = 4
+
+
+def scoring_to_array(scoring=PAM250):
+    alphabet = sorted(scoring)
+    codes = {char: index for index, char in enumerate(alphabet)}
+    array = np.array([[scoring[a][b] for b in alphabet] for a in alphabet], dtype=np.int32)
+    return codes, array
+
+
+PAM250_CODES, PAM250_ARRAY = scoring_to_array(PAM250)
+
+
+def encode(seq, codes=PAM250_CODES):
+    return np.array([codes[char] for char in seq], dtype=np.intp)
+
+
+# Yields (row, directions) for rows 1..n of the semi-global matrices, keeping only two rows alive.
+# The horizontal dependency inside a row is resolved with a prefix maximum:
+#   row[j] = max_k(candidate[k] + gap * (j - k)) = gap * j + max_k(candidate[k] - gap * k)
+def fill_rows(seq1, seq2, scoring=PAM250_ARRAY, gap_penalty=GAP_PENALTY):
+    m = len(seq2)
+    gaps = gap_penalty * np.arange(m + 1, dtype=np.int32)
+    candidate = np.zeros(m + 1, dtype=np.int32)
+    prev_row = np.zeros(m + 1, dtype=np.int32)
+
+    for i in range(1, len(seq1) + 1):
+        diagonal = prev_row[:-1] + scoring[seq1[i - 1]][seq2]
+        vertical = prev_row[1:] + gap_penalty
+
+        np.maximum(diagonal, vertical, out=candidate[1:])
+        row = np.maximum.accumulate(candidate - gaps)
+        row += gaps
+
+        cells = row[1:]
+        directions = np.zeros(m + 1, dtype=np.uint8)
+        directions[1:] = (cells == diagonal) * np.uint8(DIAGONAL)
+        directions[1:] |= (cells == row[:-1] + gap_penalty) * np.uint8(HORIZONTAL)
+        directions[1:] |= (cells == vertical) * np.uint8(VERTICAL)
+
+        yield row, directions
+        prev_row = row
+
+
+def fill_matrices(str1, str2, scoring=PAM250_ARRAY, codes=PAM250_CODES, gap_penalty=GAP_PENALTY):
+    seq1 = encode(str1, codes)
+    seq2 = encode(str2, codes)
+    n, m = len(seq1), len(seq2)
+
+    score_matrix = np.zeros((n + 1, m + 1), dtype=np.int32)
+    direction_matrix = np.zeros((n + 1, m + 1), dtype=np.uint8)
+
+    for i, (row, directions) in enumerate(fill_rows(seq1, seq2, scoring, gap_penalty), 1):
+        score_matrix[i] = row
+        direction_matrix[i] = directions
+
+    total_score = 0
+    if n and m:
+        total_score = max(0, int(score_matrix[n, 1:].max()), int(score_matrix[1:, m].max()))
+
+    return score_matrix, direction_matrix, total_score
+
+
+# Direction string ('', 'd', 'h', 'dh', ...) of every combination of direction bits
+DIRECTION_STRINGS = np.array([''.join(letter for bit, letter in ((DIAGONAL, 'd'), (HORIZONTAL, 'h'), (VERTICAL, 'v'))
+                                      if bits & bit) for bits in range(8)], dtype=object)
+
+
+def direction_strings(direction_matrix):
+    return DIRECTION_STRINGS[direction_matrix].tolist()
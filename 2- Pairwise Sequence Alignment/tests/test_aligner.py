@@ -0,0 +1,59 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+from aligner import Aligner
+
+PROTEIN = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+# seq with about rate substitutions, insertions and deletions per residue
+def mutate(rng, seq, rate=0.15):
+    result = []
+    for char in seq:
+        roll = rng.random()
+        if roll < rate / 3:
+            result.append(rng.choice(PROTEIN))
+        elif roll < 2 * rate / 3:
+            result.append(char + rng.choice(PROTEIN))
+        elif roll >= rate:
+            result.append(char)
+    return ''.join(result)
+
+
+def similar_pairs(count=200, seed=1):
+    rng = random.Random(seed)
+    for _ in range(count):
+        seq = ''.join(rng.choice(PROTEIN) for _ in range(rng.randint(0, 60)))
+        yield seq, mutate(rng, seq)
+
+
+# The optimum starts from a border cell on the edge diagonal of the band
+def test_band_widens_for_path_starting_on_its_edge():
+    assert Aligner(gap_open=-5, gap_extend=-5, band=1).align('AAW', 'WAWWAWA')[0] == 17
+
+
+# Empty input, or pairs where nothing beats leaving both sequences unaligned, give the all-gap
+# alignment in every mode
+@pytest.mark.parametrize('options', [{}, {'band': 2}, {'gap_open': -11, 'gap_extend': -1}])
+@pytest.mark.parametrize('a, b, alignment', [('', '', ('', '')), ('', 'AC', ('--', 'AC')), ('A', '', ('A', '-')),
+                                             ('WW', 'CCC', ('WW---', '--CCC'))])
+def test_all_gap_alignment(options, a, b, alignment):
+    assert Aligner(**options).align(a, b) == (0, [alignment])
+
+
+def test_all_gap_alignment_is_counted():
+    assert Aligner().count('', '') == (0, 1)
+    assert Aligner().count('WW', 'CCC') == (0, 1)
+
+
+@pytest.mark.parametrize('gap_open, gap_extend', [(-11, -1), (-9, -9), (-5, -5)])
+@pytest.mark.parametrize('band', [0, 1, 3])
+def test_banded_matches_unbanded(gap_open, gap_extend, band):
+    banded = Aligner(gap_open=gap_open, gap_extend=gap_extend, band=band)
+    full = Aligner(gap_open=gap_open, gap_extend=gap_extend)
+    for a, b in similar_pairs():
+        assert banded.score(a, b) == full.score(a, b), (a, b)
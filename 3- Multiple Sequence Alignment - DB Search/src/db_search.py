@@ -0,0 +1,265 @@
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from main import S_MATCH, S_MISSMATCH, S_GAP
+
+import shared_path
+from seq_store import parse_records, read_records
+
+WORD_SIZE = 4
+# Diagonals per database sequence that are extended without gaps, and sequences that get a banded DP
+DIAGONALS_PER_SEQ = 4
+MAX_CANDIDATES = 50
+# Extra diagonals on each side of the extended ones that the banded DP may use
+BAND_WIDTH = 8
+TOP_HITS = 10
+INDEX_ARRAYS = ('keys', 'offsets', 'posting_seqs', 'posting_positions', 'residues', 'seq_offsets')
+
+STOP = 0
+DIAGONAL = 1
+UP = 2
+LEFT = 3
+
+
+# Inverted k-mer index over a sequence database: for every k-mer present (keys, sorted), the
+# (sequence, position) postings in posting_seqs/posting_positions[offsets[i]:offsets[i + 1]], plus the
+# residues of all sequences as one uint8 array. Saved as a directory of .npy files that are
+# memory-mapped on load, so worker processes share one copy of the index.
+class KmerIndex:
+    def __init__(self, arrays, names, alphabet, k):
+        for name in INDEX_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.names = names
+        self.alphabet = alphabet
+        self.k = k
+        self.codes = np.full(256, -1, dtype=np.int64)
+        self.codes[np.frombuffer(alphabet.encode(), dtype=np.uint8)] = np.arange(len(alphabet))
+
+    @classmethod
+    def build(cls, records, k=WORD_SIZE):
+        names, seqs = [], []
+        for name, seq in records:
+            names.append(name)
+            seqs.append(seq)
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        residues = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)
+        alphabet = np.unique(residues).tobytes().decode()
+        if len(alphabet) ** k >= 2 ** 62:
+            raise ValueError(f'k={k} is too large for an alphabet of {len(alphabet)} residues')
+
+        index = cls({'residues': residues, 'seq_offsets': np.concatenate([[0], np.cumsum(lengths)]),
+                     'keys': None, 'offsets': None, 'posting_seqs': None, 'posting_positions': None},
+                    names, alphabet, k)
+
+        keys, valid = index.kmer_keys(residues)
+        # Windows that cross into the next sequence are not k-mers
+        starts = np.arange(len(keys))
+        owners = np.repeat(np.arange(len(seqs)), lengths)[:len(keys)]
+        valid &= starts + k <= index.seq_offsets[owners + 1]
+
+        starts = starts[valid]
+        order = np.argsort(keys[valid], kind='stable')
+        sorted_keys = keys[valid][order]
+        index.keys, first = np.unique(sorted_keys, return_index=True)
+        index.offsets = np.append(first, len(sorted_keys)).astype(np.int64)
+        index.posting_seqs = owners[valid][order].astype(np.int32)
+        index.posting_positions = (starts[order] - index.seq_offsets[index.posting_seqs]).astype(np.int32)
+        return index
+
+    def __len__(self):
+        return len(self.names)
+
+    def sequence(self, number):
+        return self.residues[self.seq_offsets[number]:self.seq_offsets[number + 1]]
+
+    # Key of the k-mer at every position of residues (base len(alphabet)) and whether all of its
+    # residues are in the alphabet
+    def kmer_keys(self, residues):
+        windows = len(residues) - self.k + 1
+        if windows <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+
+        codes = self.codes[residues]
+        keys = np.zeros(windows, dtype=np.int64)
+        valid = np.ones(windows, dtype=bool)
+        for t in range(self.k):
+            keys *= len(self.alphabet)
+            keys += np.maximum(codes[t:t + windows], 0)
+            valid &= codes[t:t + windows] >= 0
+        return keys, valid
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'index.json'), 'w') as file:
+            json.dump({'k': self.k, 'alphabet': self.alphabet, 'names': self.names}, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'index.json')) as file:
+            metadata = json.load(file)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in INDEX_ARRAYS}
+        return cls(arrays, metadata['names'], metadata['alphabet'], metadata['k'])
+
+    # Seed hits of a query: (sequence, diagonal = database position - query position) of every
+    # shared k-mer occurrence
+    def seed_hits(self, query):
+        keys, valid = self.kmer_keys(query)
+        query_positions = np.flatnonzero(valid)
+        slots = np.searchsorted(self.keys, keys[valid])
+        slots = np.minimum(slots, len(self.keys) - 1)
+        found = self.keys[slots] == keys[valid] if len(self.keys) else np.zeros(len(slots), dtype=bool)
+        slots, query_positions = slots[found], query_positions[found]
+
+        starts, stops = self.offsets[slots], self.offsets[slots + 1]
+        counts = stops - starts
+        # Postings of all the found k-mers gathered at once: run r covers starts[r]..stops[r]
+        runs = np.repeat(np.arange(len(slots)), counts)
+        postings = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + starts[runs]
+        seqs = np.asarray(self.posting_seqs[postings], dtype=np.int64)
+        diagonals = np.asarray(self.posting_positions[postings], dtype=np.int64) - query_positions[runs]
+        return seqs, diagonals
+
+    # Ranked hits of a query as (score, name, query start, database start, aligned query, aligned subject)
+    def search(self, query, top=TOP_HITS, max_candidates=MAX_CANDIDATES, band_width=BAND_WIDTH):
+        query = np.frombuffer(query.encode(), dtype=np.uint8)
+        seqs, diagonals = self.seed_hits(query)
+        if not len(seqs):
+            return []
+
+        # Seed hits per (sequence, diagonal), and each sequence's best diagonals by hit count
+        offset = len(query)
+        pairs, hits = np.unique(seqs * (offset + int(self.seq_offsets[-1]) + 1) + diagonals + offset,
+                                return_counts=True)
+        pair_seqs, pair_diagonals = np.divmod(pairs, offset + int(self.seq_offsets[-1]) + 1)
+        pair_diagonals -= offset
+        order = np.lexsort((-hits, pair_seqs))
+        pair_seqs, pair_diagonals = pair_seqs[order], pair_diagonals[order]
+        rank = np.arange(len(order)) - np.searchsorted(pair_seqs, pair_seqs)
+        keep = rank < DIAGONALS_PER_SEQ
+
+        candidates = {}
+        for seq, diagonal in zip(pair_seqs[keep].tolist(), pair_diagonals[keep].tolist()):
+            score = ungapped_score(query, self.sequence(seq), diagonal)
+            best, lower, upper = candidates.get(seq, (score, diagonal, diagonal))
+            candidates[seq] = (max(best, score), min(lower, diagonal), max(upper, diagonal))
+
+        ranked = sorted(candidates.items(), key=lambda item: (-item[1][0], item[0]))[:max_candidates]
+        results = []
+        for seq, (_, lower, upper) in ranked:
+            subject = self.sequence(seq)
+            score, query_start, subject_start, aligned_query, aligned_subject = banded_local_align(
+                query, subject, lower - band_width, upper + band_width)
+            results.append((score, seq, query_start, subject_start, aligned_query, aligned_subject))
+
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return [(score, self.names[seq], *rest) for score, seq, *rest in results[:top]]
+
+
+# Best ungapped segment score on one diagonal (subject position = query position + diagonal):
+# the maximum of a running sum minus the smallest running sum before it
+def ungapped_score(query, subject, diagonal):
+    query_start, subject_start = max(0, -diagonal), max(0, diagonal)
+    length = min(len(query) - query_start, len(subject) - subject_start)
+    if length <= 0:
+        return 0
+
+    scores = np.where(query[query_start:query_start + length] == subject[subject_start:subject_start + length],
+                      S_MATCH, S_MISSMATCH)
+    sums = np.concatenate([[0], np.cumsum(scores)])
+    return int((sums - np.minimum.accumulate(sums)).max())
+
+
+# Local alignment (Smith-Waterman, global_align's scores) restricted to the diagonals
+# lower <= subject position - query position <= upper. Rows are kept in diagonal coordinates,
+# t = j - i - lower, so the diagonal neighbour has the same offset in the previous row, the upper one
+# offset t + 1 and the left one t - 1; the left chain is resolved with a prefix maximum.
+# Returns the score, the start of the alignment in both sequences and the aligned strings.
+def banded_local_align(query, subject, lower, upper):
+    n, m = len(query), len(subject)
+    lower, upper = max(lower, -n), min(upper, m)
+    width = upper - lower + 1
+    offsets = np.arange(width)
+    gaps = S_GAP * offsets
+
+    directions = np.zeros((n + 1, width), dtype=np.uint8)
+    previous = np.where((lower + offsets >= 0) & (lower + offsets <= m), 0, -np.inf)
+    best_score, best_cell = 0, (0, 0)
+
+    for i in range(1, n + 1):
+        columns = i + lower + offsets
+        inside = (columns >= 1) & (columns <= m)
+        substitution = np.where(subject[np.clip(columns - 1, 0, m - 1)] == query[i - 1], S_MATCH, S_MISSMATCH)
+        diagonal = np.where(inside, previous + substitution, -np.inf)
+        up = np.where(inside, np.append(previous[1:], -np.inf) + S_GAP, -np.inf)
+
+        candidate = np.maximum(np.maximum(diagonal, up), np.where(inside | (columns == 0), 0, -np.inf))
+        row = np.maximum.accumulate(candidate - gaps) + gaps
+        row[~(inside | (columns == 0))] = -np.inf
+
+        directions[i] = np.where(row <= 0, STOP, np.where(row == diagonal, DIAGONAL, np.where(row == up, UP, LEFT)))
+        t = int(np.argmax(row))
+        if row[t] > best_score:
+            best_score, best_cell = int(row[t]), (i, t)
+        previous = row
+
+    i, t = best_cell
+    aligned_query, aligned_subject = [], []
+    while i > 0 and directions[i, t] != STOP:
+        j = i + lower + t
+        direction = directions[i, t]
+        if direction == DIAGONAL:
+            aligned_query.append(chr(query[i - 1]))
+            aligned_subject.append(chr(subject[j - 1]))
+            i -= 1
+        elif direction == UP:
+            aligned_query.append(chr(query[i - 1]))
+            aligned_subject.append('-')
+            i, t = i - 1, t + 1
+        else:
+            aligned_query.append('-')
+            aligned_subject.append(chr(subject[j - 1]))
+            t -= 1
+
+    return (best_score, i, i + lower + t, ''.join(reversed(aligned_query)), ''.join(reversed(aligned_subject)))
+
+
+# (name, sequence) records of a FASTA file, a sequence store, or a file with one sequence per line
+# (named by number)
+def read_sequences(path):
+    return ((name, seq) for name, _, seq in read_records(path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='k-mer seeded database search')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='index a FASTA database or sequence store')
+    build.add_argument('database')
+    build.add_argument('index', help='directory the index is written to')
+    build.add_argument('-k', type=int, default=WORD_SIZE)
+    search = commands.add_parser('search', help='search queries (FASTA, or one per line on stdin) in an index')
+    search.add_argument('index')
+    search.add_argument('queries', nargs='?', default=None)
+    search.add_argument('--top', type=int, default=TOP_HITS)
+    search.add_argument('--candidates', type=int, default=MAX_CANDIDATES)
+    search.add_argument('--band', type=int, default=BAND_WIDTH)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = KmerIndex.build(read_sequences(args.database), args.k)
+        index.save(args.index)
+        print(f'{len(index)} sequences, {len(index.keys)} distinct {index.k}-mers -> {args.index}', file=sys.stderr)
+    else:
+        index = KmerIndex.load(args.index)
+        queries = read_sequences(args.queries) if args.queries else \
+            ((name, seq) for name, _, seq in parse_records(sys.stdin))
+        for name, query in queries:
+            print(f'> {name}')
+            for score, hit, query_start, subject_start, aligned_query, aligned_subject in index.search(
+                    query, args.top, args.candidates, args.band):
+                print(f'{hit}\t{score}\t{query_start}\t{subject_start}\t{aligned_query}\t{aligned_subject}')
@@ -0,0 +1,246 @@
+import argparse
+import sys
+
+import numpy as np
+
+from main import S_MATCH, get_input, fill_matrix_and_find_center, star_alignment
+from msa import MSA
+
+TREE_METHODS = ('upgma', 'nj')
+
+
+# Rooted or unrooted tree over named leaves. Nodes 0 .. leaves - 1 are the leaves; internal node
+# leaves + k has the children children[k], which always have smaller numbers, so the internal nodes
+# in order are a post-order and no traversal needs recursion (trees of thousands of leaves can be
+# deeper than Python's recursion limit). lengths[node] is the length of the branch above node.
+class Tree:
+    def __init__(self, names, children, lengths):
+        self.names = names
+        self.children = children
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def root(self):
+        return len(self.names) + len(self.children) - 1
+
+    def newick(self):
+        text = {node: name for node, name in enumerate(self.names)}
+        for node, children in enumerate(self.children, len(self.names)):
+            text[node] = '(' + ','.join(f'{text.pop(child)}:{self.lengths[child]:.6g}' for child in children) + ')'
+        return text[self.root] + ';' if self.names else ';'
+
+    # Fitch parsimony score of an alignment whose rows are the leaves in order, gaps counting as a
+    # state. Every state set is a bitmask of symbols, so a column's intersection or union is one AND
+    # or OR, and all columns of a node are combined at once.
+    def parsimony(self, aligned_seqs):
+        data = aligned_seqs.data if isinstance(aligned_seqs, MSA) else MSA.from_strings(aligned_seqs).data
+        if len(data) != len(self.names):
+            raise ValueError(f'{len(data)} aligned sequences for a tree of {len(self.names)} leaves')
+
+        symbols, inverse = np.unique(data, return_inverse=True)
+        if len(symbols) > 64:
+            raise ValueError(f'{len(symbols)} symbols do not fit in a 64-bit state set')
+        dtype = next(dtype for dtype in (np.uint8, np.uint16, np.uint32, np.uint64)
+                     if len(symbols) <= 8 * np.dtype(dtype).itemsize)
+        masks = np.left_shift(1, np.arange(len(symbols), dtype=np.uint64)).astype(dtype)
+        sets = dict(enumerate(masks[inverse.reshape(data.shape)]))
+
+        score = 0
+        for node, children in enumerate(self.children, len(self.names)):
+            state = sets.pop(children[0])
+            for child in children[1:]:
+                other = sets.pop(child)
+                common = state & other
+                empty = common == 0
+                score += int(empty.sum())
+                state = np.where(empty, state | other, common)
+            sets[node] = state
+        return score
+
+
+# Distances from the pairwise global alignment scores: the mean self score of the two sequences
+# (every residue matched) minus their score, so identical sequences are 0 apart
+def distance_matrix(score_matrix, seqs):
+    self_scores = S_MATCH * np.array([len(seq) for seq in seqs], dtype=np.float64)
+    distances = (self_scores[:, np.newaxis] + self_scores) / 2 - score_matrix
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+# UPGMA: merge the closest clusters and average their distances by size. Each row keeps its minimum
+# and where it is, so a merge only rescans the rows whose minimum was one of the merged clusters;
+# every other row just compares against its new distance to the merged cluster.
+def upgma(distances, names):
+    n = len(names)
+    if n < 2:
+        return Tree(list(names), [], np.zeros(n))
+
+    distances = np.array(distances, dtype=np.float64)
+    np.fill_diagonal(distances, np.inf)
+    sizes = np.ones(n)
+    heights = np.zeros(2 * n - 1)
+    lengths = np.zeros(2 * n - 1)
+    nodes = np.arange(n)
+    children = []
+    row_min = distances.min(axis=1)
+    row_arg = distances.argmin(axis=1)
+
+    for node in range(n, 2 * n - 1):
+        i = int(np.argmin(row_min))
+        j = int(row_arg[i])
+        heights[node] = distances[i, j] / 2
+        for slot in (i, j):
+            lengths[nodes[slot]] = heights[node] - heights[nodes[slot]]
+        children.append((int(nodes[i]), int(nodes[j])))
+
+        # The merged cluster takes slot i; slot j becomes inf everywhere
+        merged = (sizes[i] * distances[i] + sizes[j] * distances[j]) / (sizes[i] + sizes[j])
+        merged[i] = np.inf
+        distances[i], distances[:, i] = merged, merged
+        distances[j], distances[:, j] = np.inf, np.inf
+        sizes[i] += sizes[j]
+        nodes[i] = node
+
+        row_min[j] = np.inf
+        closer = merged < row_min
+        row_min[closer], row_arg[closer] = merged[closer], i
+        stale = np.flatnonzero(((row_arg == i) | (row_arg == j)) & ~closer & np.isfinite(row_min))
+        stale = np.union1d(stale, [i])
+        row_arg[stale] = distances[stale].argmin(axis=1)
+        row_min[stale] = distances[stale, row_arg[stale]]
+
+    return Tree(list(names), children, lengths)
+
+
+# Neighbor-joining. The active clusters are kept in the leading r x r block of the distance matrix
+# (the last cluster moves into the slot that a join frees) and the row sums are updated in O(r).
+# The pair to join is found without the whole Q matrix, as in RapidNJ: every row also keeps its
+# distances sorted, with the nodes they lead to, and is read from the closest node on only until
+# (r - 2) * d - sum(row) - max(sums), a lower bound on the rest of the row's Q, exceeds the best Q
+# found so far. A joined cluster gets a new sorted row (its pairs with older clusters are found from
+# there); entries of joined nodes are skipped, and all rows are sorted again whenever the number of
+# clusters has halved. The last three clusters are joined at an unrooted (trifurcating) root;
+# negative branch lengths are set to 0.
+def neighbor_joining(distances, names):
+    n = len(names)
+    if n < 3:
+        return upgma(distances, names)
+
+    distances = np.array(distances, dtype=np.float64)
+    sums = distances.sum(axis=1)
+    lengths = np.zeros(2 * n - 2)
+    nodes = np.arange(n)
+    children = []
+    # Slot of every node in the distance matrix, -1 once joined (the last entry pads sorted rows)
+    slots = np.full(2 * n - 1, -1, dtype=np.intp)
+    slots[:n] = nodes
+    sorted_distances = np.full((n, n + 1), np.inf)
+    sorted_nodes = np.full((n, n + 1), len(slots) - 1, dtype=np.intp)
+    sorted_size = 0
+
+    for r in range(n, 3, -1):
+        block = distances[:r, :r]
+        if 2 * r <= sorted_size or not sorted_size:
+            sort_rows(block, nodes, np.arange(r), sorted_distances, sorted_nodes)
+            sorted_size = r
+        i, j = closest_pair(sums[:r], slots, sorted_distances, sorted_nodes)
+
+        length_i = block[i, j] / 2 + (sums[i] - sums[j]) / (2 * (r - 2))
+        lengths[nodes[i]], lengths[nodes[j]] = length_i, block[i, j] - length_i
+        node = n + len(children)
+        children.append((int(nodes[i]), int(nodes[j])))
+
+        joined = (block[i] + block[j] - block[i, j]) / 2
+        joined[i] = joined[j] = 0
+        sums[:r] += joined - block[:, i] - block[:, j]
+        sums[i] = joined.sum()
+        block[i], block[:, i] = joined, joined
+        slots[nodes[i]] = slots[nodes[j]] = -1
+        nodes[i], slots[node] = node, i
+        sort_rows(block, nodes, [i], sorted_distances, sorted_nodes)
+
+        last = r - 1
+        if j != last:
+            block[j], block[:, j] = block[last], block[:, last]
+            block[j, j] = 0
+            sums[j], nodes[j] = sums[last], nodes[last]
+            sorted_distances[j], sorted_nodes[j] = sorted_distances[last], sorted_nodes[last]
+            slots[nodes[j]] = j
+
+    a, b, c = 0, 1, 2
+    block = distances[:3, :3]
+    lengths[nodes[a]] = (block[a, b] + block[a, c] - block[b, c]) / 2
+    lengths[nodes[b]] = (block[a, b] + block[b, c] - block[a, c]) / 2
+    lengths[nodes[c]] = (block[a, c] + block[b, c] - block[a, b]) / 2
+    children.append(tuple(int(node) for node in nodes[:3]))
+
+    return Tree(list(names), children, np.maximum(lengths, 0))
+
+
+# Sorted distances of the given rows of block to the other clusters, and the nodes they lead to
+def sort_rows(block, nodes, rows, sorted_distances, sorted_nodes):
+    rows = np.asarray(rows)
+    values = block[rows]
+    values[np.arange(len(rows)), rows] = np.inf
+    order = np.argsort(values, axis=1)
+    width = block.shape[1]
+    sorted_distances[rows, :width] = np.take_along_axis(values, order, axis=1)
+    sorted_distances[rows, width:] = np.inf
+    sorted_nodes[rows, :width] = nodes[order]
+
+
+# Slots (i < j) of the pair with the smallest Q = (r - 2) * d(i, j) - sum(i) - sum(j), the first in
+# row order on ties like an argmin over the Q matrix. The rows still in question are read a few
+# sorted columns at a time, twice as many every pass.
+def closest_pair(sums, slots, sorted_distances, sorted_nodes):
+    r = len(sums)
+    largest_sum = sums.max()
+    rows = np.arange(r)
+    best, best_pair = np.inf, (r, r)
+    start, width = 0, 8
+
+    while len(rows):
+        stop = min(start + width, sorted_distances.shape[1] - 1)
+        others = slots[sorted_nodes[rows, start:stop]]
+        q = (r - 2) * sorted_distances[rows, start:stop] - sums[rows, np.newaxis] - sums[others]
+        q[others < 0] = np.inf
+        low = q.min() if q.size else np.inf
+        if low < np.inf and low <= best:
+            hit_rows, hit_columns = np.nonzero(q == low)
+            firsts = np.minimum(rows[hit_rows], others[hit_rows, hit_columns])
+            seconds = np.maximum(rows[hit_rows], others[hit_rows, hit_columns])
+            hit = np.lexsort((seconds, firsts))[0]
+            best, best_pair = min((best, best_pair), (low, (int(firsts[hit]), int(seconds[hit]))))
+
+        bounds = (r - 2) * sorted_distances[rows, stop] - sums[rows] - largest_sum
+        rows = rows[bounds <= best]
+        start, width = stop, 2 * width
+
+    return best_pair
+
+
+def build_tree(distances, names, method='nj'):
+    if method not in TREE_METHODS:
+        raise ValueError(f'method must be one of {TREE_METHODS}')
+    return upgma(distances, names) if method == 'upgma' else neighbor_joining(distances, names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Guide tree (Newick) from the pairwise alignment scores of the MSA')
+    parser.add_argument('--method', choices=TREE_METHODS, default='nj')
+    parser.add_argument('--parsimony', action='store_true', help='also print the Fitch score of the star alignment')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes for the pairwise scores')
+    args = parser.parse_args()
+
+    seqs = get_input()
+    score_matrix, center_seq = fill_matrix_and_find_center(seqs, args.processes)
+    tree = build_tree(distance_matrix(score_matrix, seqs), [str(number) for number in range(len(seqs))],
+                      args.method)
+    print(tree.newick())
+
+    if args.parsimony:
+        aligned_seqs = star_alignment(center_seq, score_matrix, seqs)
+        print(f'parsimony: {tree.parsimony(aligned_seqs)}', file=sys.stderr)
@@ -1,11 +1,24 @@
-import operator
+import argparse
+import functools
+
+import numpy as np
+
+from msa import MSA, column_scores
+from pairwise_scores import pairwise_score_matrix, find_center
+
+import shared_path
+import instrument
 
 S_MATCH = 3
 S_MISSMATCH = -1
 S_GAP = -2
+# Center-to-sequence alignments reused by star_alignment across refinement rounds
+ALIGN_CACHE_SIZE = 4096
 
 
 def global_align(x, y, s_match, s_mismatch, s_gap):
+    instrument.count('alignments')
+    instrument.count('cells', len(x) * len(y))
     A = []
 
     for i in range(len(y) + 1):
@@ -60,6 +73,11 @@ def global_align(x, y, s_match, s_mismatch, s_gap):
     return (align_X, align_Y, A[len(y)][len(x)])
 
 
+@functools.lru_cache(maxsize=ALIGN_CACHE_SIZE)
+def cached_global_align(x, y):
+    return global_align(x, y, S_MATCH, S_MISSMATCH, S_GAP)
+
+
 def get_input():
     number_of_seqs = input()
     input_seqs = []
@@ -68,213 +86,108 @@ def get_input():
     return input_seqs
 
 
-def fill_matrix_and_find_center(seqs):
-    max_score = float('-inf')
-    center_seq = ''
-    score_matrix = {}
-
-    for seq1 in seqs:
-        score_matrix[seqs.index(seq1)] = {}
-        total_score = 0
-
-        for seq2 in seqs:
-
-            if seqs.index(seq1) != seqs.index(seq2):
-                x, y, score = global_align(seq1, seq2, S_MATCH, S_MISSMATCH, S_GAP)
-                score_matrix[seqs.index(seq1)][seqs.index(seq2)] = score
-
-                total_score += score
-
-        if total_score > max_score:
-            max_score = total_score
-
-            center_seq = seq1
+def fill_matrix_and_find_center(seqs, processes=None):
+    score_matrix, aligned_pairs = pairwise_score_matrix(seqs, S_MATCH, S_MISSMATCH, S_GAP, processes)
+    center_seq = seqs[find_center(score_matrix)] if seqs else ''
+    # Pairs served from the score cache cost no DP cells and are not counted
+    if instrument.enabled:
+        instrument.count('scored_pairs', len(aligned_pairs))
+        instrument.count('cells', sum(len(seqs[i]) * len(seqs[j]) for i, j in aligned_pairs))
 
     return score_matrix, center_seq
 
 
-def always_a_gap(center, updated_center, last_seqs):
-    loc1 = 0
-    loc2 = 0
-    loc3 = 0
-    total_center = ''
-
-    while loc1 < len(center) and loc2 < len(updated_center):
-
-        if center[loc1] == updated_center[loc2]:
-            total_center += center[loc1]
-            loc1 += 1
-            loc2 += 1
-            loc3 += 1
-
-        elif center[loc1] == '-':
-            total_center += '-'
-            loc1 += 1
-            loc3 += 1
-
-        elif updated_center[loc2] == '-':
-            total_center += '-'
-            for seq in last_seqs:
-                for index in range(len(seq)):
-                    if index == loc3:
-                        last_seqs[last_seqs.index(seq)] = seq[0:loc3] + '-' + seq[loc3:]
-                        break
-            loc2 += 1
-            loc3 += 1
-
-    for i in range(loc3, loc3 + len(updated_center) - loc2):
-        for seq in last_seqs:
-            total_center += '-'
-            last_seqs[last_seqs.index(seq)] = seq[0:i] + '-' + seq[i:]
-
-    for i in range(loc3, loc3 + len(updated_center) - loc1):
-        for seq in last_seqs:
-            total_center += '-'
-
-
 def star_alignment(center_seq, score_matrix, seqs):
-    sorted_seqs = sorted(score_matrix[seqs.index(center_seq)].items(), key=operator.itemgetter(1), reverse=True)
+    center = seqs.index(center_seq)
+    sorted_seqs = sorted((i for i in range(len(seqs)) if i != center), key=lambda i: score_matrix[center][i],
+                         reverse=True)
 
-    aligned_seqs = []
+    aligned_seqs = MSA.empty(len(center_seq))
     new_center_seq = center_seq
 
     for seq in sorted_seqs:
         last_center_seq = new_center_seq
 
-        new_seq, new_center_seq, score = global_align(seqs[seq[0]], new_center_seq, S_MATCH, S_MISSMATCH, S_GAP)
+        with instrument.stage('pairwise_align'):
+            new_seq, new_center_seq, score = cached_global_align(seqs[seq], new_center_seq)
 
-        always_a_gap(last_center_seq, new_center_seq, aligned_seqs)
-        aligned_seqs.append(new_seq)
+        with instrument.stage('merge'):
+            aligned_seqs.merge(last_center_seq, new_center_seq, new_seq)
 
-    aligned_seqs = [new_center_seq] + aligned_seqs
+    aligned_seqs.append_row(new_center_seq)
 
-    output_seqs = []
-    for seq in seqs:
-        for aligned_seq in aligned_seqs:
-            if aligned_seq.replace('-', '') == seq:
-                output_seqs.append(aligned_seq)
+    # Rows were added in star order with the center last; put them back in input order
+    row_of_seq = [0] * len(seqs)
+    for row, seq in enumerate(sorted_seqs + [center]):
+        row_of_seq[seq] = row
 
-    return output_seqs
+    return aligned_seqs.reorder(row_of_seq)
 
 
 def calculate_alignment_score(columns):
-    total_score = 0
-    for column in columns:
-        for i in range(len(column)):
-            for j in range(i + 1, len(column)):
-                if column[i] == '-' and column[j] == '-':
-                    total_score += 0
-                elif column[i] == '-' or column[j] == '-':
-                    total_score += -2
-                elif column[i] != column[j]:
-                    total_score += -1
-                elif column[i] == column[j]:
-                    total_score += 3
-    return total_score
+    return int(column_scores(columns, S_MATCH, S_MISSMATCH, S_GAP).sum())
 
 
 def calculate_columns(aligned_seqs):
-    columns = []
-    for i in range(len(aligned_seqs[0])):
-        columns.append([])
-        for aligned_seq in aligned_seqs:
-            columns[i].append(aligned_seq[i])
-    return columns
-
-
-def block_improvement(seqs_columns, aligned_seqs):
-    improved = False
-    not_valid_column_indexes = []
-    for i in range(len(seqs_columns)):
-        same_chars = 0
-        for j in range(len(seqs_columns[i])):
-            if seqs_columns[i][j] != seqs_columns[i][j - 1]:
-                same_chars = 1
-                break
-        if same_chars == 0:
-            not_valid_column_indexes.append(i)
+    return aligned_seqs.columns()
 
+
+def find_blocks(not_valid_column_indexes, column_count):
     blocks = []
     for i in range(len(not_valid_column_indexes)):
 
         if i == len(not_valid_column_indexes) - 1:
             if not_valid_column_indexes[i] - not_valid_column_indexes[i - 1] > 2:
                 blocks.append([not_valid_column_indexes[i - 1] + 1, not_valid_column_indexes[i]])
-                # print([not_valid_column_indexes[i - 1] + 1, not_valid_column_indexes[i]])
-            if len(seqs_columns) - 1 - not_valid_column_indexes[i] > 2:
-                blocks.append([not_valid_column_indexes[i] + 1, len(seqs_columns)])
-            # print([not_valid_column_indexes[i] + 1, len(seqs_columns)])
+            if column_count - 1 - not_valid_column_indexes[i] > 2:
+                blocks.append([not_valid_column_indexes[i] + 1, column_count])
 
         elif i == 0:
             if not_valid_column_indexes[i] > 1:
                 blocks.append([0, not_valid_column_indexes[i]])
-                # print([0, not_valid_column_indexes[i] - 1])
 
         elif not_valid_column_indexes[i] - not_valid_column_indexes[i - 1] > 2:
             blocks.append([not_valid_column_indexes[i - 1] + 1, not_valid_column_indexes[i]])
-            # print([not_valid_column_indexes[i - 1] + 1, not_valid_column_indexes[i]])
-
-    final_seqs = aligned_seqs.copy()
-    len_difference = 0
-
-    for block in blocks:
-        # print(block)
-        # print(seqs_columns[block[0]:block[1]])
-        last_score = calculate_alignment_score(columns=seqs_columns[block[0]:block[1]])
-        # print(last_score)
-
-        block_seqs = []
-        for seq in aligned_seqs:
-            block_seqs.append(seq[block[0]:block[1]].replace('-', ''))
-
-        block_score_matrix, block_center_seq = fill_matrix_and_find_center(block_seqs)
-        aligned_block_seqs = star_alignment(block_center_seq, block_score_matrix, block_seqs)
-        block_seqs_columns = calculate_columns(aligned_block_seqs)
-        block_alignment_score = calculate_alignment_score(block_seqs_columns)
-        # print(block_alignment_score)
-
-        if block_alignment_score > last_score:
-            improved = True
-            new_alignment = []
-            for i in range(len(final_seqs)):
-                final_seqs[i] = final_seqs[i][0:block[0] - len_difference] + aligned_block_seqs[i] + final_seqs[i][
-                                                                                                     block[
-                                                                                                         1] - len_difference:]
-                # print(final_seqs)
-
-            len_difference = block[1] - block[0] - len(aligned_block_seqs[0])
-    return improved, final_seqs
+    return blocks
 
 
 if __name__ == '__main__':
+    # refinement imports this module, so it is only loaded when running as a script
+    from refinement import refine_alignment
+
+    parser = argparse.ArgumentParser(description='Star alignment with block refinement')
+    parser.add_argument('--rounds', type=int, default=None, help='maximum number of refinement rounds')
+    parser.add_argument('--time-budget', type=float, default=None, help='stop refining after this many seconds')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes for scoring and refinement')
+    parser.add_argument('--stats', nargs='?', const='-', metavar='FILE',
+                        help='write stage timings and counts as JSON to FILE (stderr if no FILE is given)')
+    args = parser.parse_args()
+    if args.stats:
+        instrument.enable()
+
     seqs = get_input()
-    updated_center_seq = ''
-    score_matrix, center_seq = fill_matrix_and_find_center(seqs)
+    with instrument.stage('center'):
+        score_matrix, center_seq = fill_matrix_and_find_center(seqs, args.processes)
 
-    aligned_seqs = star_alignment(center_seq, score_matrix, seqs)
-    seqs_columns = calculate_columns(aligned_seqs)
-    alignment_score = calculate_alignment_score(seqs_columns)
+    with instrument.stage('star_alignment'):
+        aligned_seqs = star_alignment(center_seq, score_matrix, seqs)
+        seqs_columns = calculate_columns(aligned_seqs)
+        alignment_score = calculate_alignment_score(seqs_columns)
 
     print(alignment_score)
-    for output_seq in aligned_seqs:
+    for output_seq in aligned_seqs.to_strings():
         print(output_seq)
     print()
 
-    output_seqs = aligned_seqs
-
-    while True:
-        # print()
-        output_columns = calculate_columns(output_seqs)
-        # print('aaa\n', output_seqs)
-        improved, output_seqs = block_improvement(output_columns, output_seqs)
-        if not improved:
-            break
-
-    output_columns = calculate_columns(output_seqs)
-    improved, output_seqs = block_improvement(output_columns, output_seqs)
+    # Blocks realigned in worker processes are timed with the refinement but not counted
+    with instrument.stage('refinement'):
+        output_seqs, round_scores = refine_alignment(aligned_seqs, args.rounds, args.time_budget, args.processes)
+    instrument.record('sequences', len(seqs))
+    instrument.record('refinement_rounds', len(round_scores) - 1)
+    instrument.record('round_scores', round_scores)
+    instrument.record('score_deltas', np.diff(round_scores).tolist())
 
-    output_columns = calculate_columns(output_seqs)
-    output_score = calculate_alignment_score(output_columns)
-    print(output_score)
-    for output_seq in output_seqs:
+    print(round_scores[-1])
+    for output_seq in output_seqs.to_strings():
         print(output_seq)
+    instrument.emit(args.stats)
@@ -0,0 +1,111 @@
+import numpy as np
+
+GAP = ord('-')
+
+
+# Multiple alignment stored as a rows x columns uint8 array of residue bytes. The array is kept
+# column-major, so a column (what scoring and block detection look at) is one contiguous slice.
+class MSA:
+    def __init__(self, data):
+        self.data = np.asfortranarray(data, dtype=np.uint8)
+
+    @classmethod
+    def from_strings(cls, seqs):
+        length = len(seqs[0]) if seqs else 0
+        data = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8).reshape(len(seqs), length)
+        return cls(data)
+
+    @classmethod
+    def empty(cls, length=0):
+        return cls(np.zeros((0, length), dtype=np.uint8))
+
+    def to_strings(self):
+        return [row.tobytes().decode() for row in np.ascontiguousarray(self.data)]
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def length(self):
+        return self.data.shape[1]
+
+    def columns(self):
+        return self.data.T
+
+    # positions are column indexes of the current alignment; every entry inserts one gap
+    # column before that index (len(self) appends at the end), all in a single copy
+    def insert_gap_columns(self, positions):
+        if positions:
+            self.data = np.asfortranarray(np.insert(self.data, positions, GAP, axis=1))
+
+    def append_row(self, seq):
+        row = np.frombuffer(seq.encode(), dtype=np.uint8)
+        self.data = np.asfortranarray(np.vstack([self.data, row[np.newaxis, :]]))
+
+    # Profile merge of one pairwise alignment into the star: center is the center row as it is
+    # aligned now, updated_center/new_seq the pairwise alignment of the center with a new sequence
+    def merge(self, center, updated_center, new_seq):
+        self.insert_gap_columns(gap_columns(center, updated_center))
+        self.append_row(new_seq)
+
+    def reorder(self, order):
+        return MSA(self.data[order])
+
+    def block(self, start, stop):
+        return MSA(self.data[:, start:stop])
+
+    def degapped_block(self, start, stop):
+        return [seq.replace('-', '') for seq in self.block(start, stop).to_strings()]
+
+    def replace_block(self, start, stop, block):
+        return MSA(np.hstack([self.data[:, :start], block.data, self.data[:, stop:]]))
+
+
+# Columns before which the aligned center gained a gap, in the coordinates of center.
+# Walks both versions of the center the same way always_a_gap in main.py did.
+def gap_columns(center, updated_center):
+    positions = []
+    loc1 = 0
+    loc2 = 0
+
+    while loc1 < len(center) and loc2 < len(updated_center):
+        if center[loc1] == updated_center[loc2]:
+            loc1 += 1
+            loc2 += 1
+        elif center[loc1] == '-':
+            loc1 += 1
+        elif updated_center[loc2] == '-':
+            positions.append(loc1)
+            loc2 += 1
+
+    positions += [loc1] * (len(updated_center) - loc2)
+    return positions
+
+
+# Sum-of-pairs score of every column from its symbol counts instead of all row pairs:
+# with c_s rows holding residue s, g gaps and r = rows - g residues in a column,
+#   matches = sum(c_s * (c_s - 1) / 2), mismatches = r * (r - 1) / 2 - matches, residue/gap pairs = g * r
+# and gap/gap pairs score 0. columns is the (columns x rows) view from MSA.columns().
+def column_scores(columns, s_match, s_mismatch, s_gap):
+    length, rows = columns.shape
+    if length == 0 or rows == 0:
+        return np.zeros(length, dtype=np.int64)
+
+    symbols, inverse = np.unique(columns, return_inverse=True)
+    cells = inverse.reshape(length, rows) + len(symbols) * np.arange(length)[:, np.newaxis]
+    counts = np.bincount(cells.ravel(), minlength=length * len(symbols)).reshape(length, len(symbols))
+
+    is_gap = symbols == GAP
+    gaps = counts[:, is_gap].sum(axis=1)
+    residues = rows - gaps
+    residue_counts = counts[:, ~is_gap]
+
+    matches = (residue_counts * (residue_counts - 1) // 2).sum(axis=1)
+    mismatches = residues * (residues - 1) // 2 - matches
+    return s_match * matches + s_mismatch * mismatches + s_gap * gaps * residues
+
+
+# Column scores after columns [start, stop) were replaced by block, rescoring only the block
+def rescore_block(scores, start, stop, block, s_match, s_mismatch, s_gap):
+    block_scores = column_scores(block.columns(), s_match, s_mismatch, s_gap)
+    return np.concatenate([scores[:start], block_scores, scores[stop:]])
@@ -0,0 +1,129 @@
+import collections
+import concurrent.futures
+import itertools
+
+import numpy as np
+
+GAP = ord('-')
+# Below this many pairs the process pool costs more than it saves
+PARALLEL_THRESHOLD = 256
+CHUNK_SIZE = 64
+# Pair scores kept between calls, evicting the least recently used ones
+SCORE_CACHE_SIZE = 100000
+
+worker_seqs = []
+worker_scores = ()
+score_cache = collections.OrderedDict()
+
+
+def encode(seq):
+    return np.frombuffer(seq.encode(), dtype=np.uint8)
+
+
+# Score of global_align(x, y, ...) computed with two rows only. global_align is symmetric,
+# so the rows run along the shorter sequence and memory is O(min(len(x), len(y))).
+def global_align_score(x, y, s_match, s_mismatch, s_gap):
+    if len(x) > len(y):
+        x, y = y, x
+    if len(x) == 0:
+        return s_gap * len(y)
+
+    x = encode(x)
+    y = encode(y)
+    x_gap = x == GAP
+    gaps = s_gap * np.arange(len(x) + 1, dtype=np.int64)
+
+    # One substitution row per distinct residue of y
+    substitutions = {}
+    for char in np.unique(y).tolist():
+        if char == GAP:
+            substitutions[char] = np.full(len(x), s_gap, dtype=np.int64)
+        else:
+            substitutions[char] = np.where(x_gap, s_gap, np.where(x == char, s_match, s_mismatch))
+
+    row = gaps.copy()
+    candidate = np.empty(len(x) + 1, dtype=np.int64)
+    shifted = candidate[1:]
+
+    for i, char in enumerate(y.tolist(), 1):
+        candidate[0] = s_gap * i
+        np.add(row[:-1], substitutions[char], out=shifted)
+        np.maximum(shifted, row[1:] + s_gap, out=shifted)
+        # Horizontal moves inside the row: row[j] = max_k(candidate[k] + s_gap * (j - k))
+        np.subtract(candidate, gaps, out=row)
+        np.maximum.accumulate(row, out=row)
+        row += gaps
+
+    return int(row[-1])
+
+
+def init_worker(seqs, scores):
+    global worker_seqs, worker_scores
+    worker_seqs = seqs
+    worker_scores = scores
+
+
+def score_pairs(pairs):
+    s_match, s_mismatch, s_gap = worker_scores
+    return [global_align_score(worker_seqs[i], worker_seqs[j], s_match, s_mismatch, s_gap) for i, j in pairs]
+
+
+def cache_key(x, y, scores):
+    return (x, y, scores) if x <= y else (y, x, scores)
+
+
+def cache_get(key):
+    score = score_cache.get(key)
+    if score is not None:
+        score_cache.move_to_end(key)
+    return score
+
+
+def cache_put(key, score):
+    score_cache[key] = score
+    score_cache.move_to_end(key)
+    while len(score_cache) > SCORE_CACHE_SIZE:
+        score_cache.popitem(last=False)
+
+
+# Symmetric all-vs-all global alignment score matrix. Only the upper triangle is considered,
+# pairs already in the LRU cache (or repeated within this batch) are not aligned again, and
+# large batches are spread over a process pool while small ones are scored in this process.
+# Returns the matrix and the pairs (i, j) that were actually aligned.
+def pairwise_score_matrix(seqs, s_match, s_mismatch, s_gap, processes=None):
+    scores = (s_match, s_mismatch, s_gap)
+    pairs = list(itertools.combinations(range(len(seqs)), 2))
+    score_matrix = np.zeros((len(seqs), len(seqs)), dtype=np.int64)
+    if not pairs:
+        return score_matrix, []
+
+    keys = [cache_key(seqs[i], seqs[j], scores) for i, j in pairs]
+    missing = {}
+    for pair, key in zip(pairs, keys):
+        if key not in missing and cache_get(key) is None:
+            missing[key] = pair
+    missing_pairs = list(missing.values())
+
+    if processes == 1 or len(missing_pairs) < PARALLEL_THRESHOLD:
+        init_worker(seqs, scores)
+        new_scores = score_pairs(missing_pairs)
+    else:
+        chunks = [missing_pairs[k:k + CHUNK_SIZE] for k in range(0, len(missing_pairs), CHUNK_SIZE)]
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=init_worker,
+                                                    initargs=(seqs, scores)) as executor:
+            new_scores = list(itertools.chain.from_iterable(executor.map(score_pairs, chunks)))
+
+    found = dict(zip(missing, new_scores))
+    for key, score in found.items():
+        cache_put(key, score)
+
+    pair_scores = [found[key] if key in found else cache_get(key) for key in keys]
+    rows, columns = np.array(pairs).T
+    score_matrix[rows, columns] = pair_scores
+    score_matrix[columns, rows] = pair_scores
+    return score_matrix, missing_pairs
+
+
+# Center of the star: the sequence with the highest total score against all others (first one on ties)
+def find_center(score_matrix):
+    return int(np.argmax(score_matrix.sum(axis=1)))
@@ -0,0 +1,77 @@
+import concurrent.futures
+import time
+
+import numpy as np
+
+from main import S_MATCH, S_MISSMATCH, S_GAP, fill_matrix_and_find_center, star_alignment, find_blocks
+from msa import column_scores, rescore_block
+
+# Below this many blocks in a round the process pool costs more than it saves
+PARALLEL_BLOCKS = 4
+
+
+def conserved_columns(data):
+    return (data == data[:1]).all(axis=0)
+
+
+def realign_block(block_seqs):
+    block_score_matrix, block_center_seq = fill_matrix_and_find_center(block_seqs, processes=1)
+    aligned_block_seqs = star_alignment(block_center_seq, block_score_matrix, block_seqs)
+    return aligned_block_seqs, int(column_scores(aligned_block_seqs.columns(), S_MATCH, S_MISSMATCH, S_GAP).sum())
+
+
+# Block refinement of an MSA until no block improves or the round/time budget runs out.
+# Conserved columns and per-column scores are kept between rounds and only updated where a block
+# was replaced; a block whose contents were already realigned without gain is not realigned again.
+# Blocks of one round are independent, so they are realigned concurrently in a process pool.
+# Returns the refined alignment and the score after every round (including the starting one).
+def refine_alignment(aligned_seqs, max_rounds=None, time_budget=None, processes=None):
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    conserved = conserved_columns(aligned_seqs.data)
+    scores = column_scores(aligned_seqs.columns(), S_MATCH, S_MISSMATCH, S_GAP)
+    checked_blocks = set()
+    round_scores = [int(scores.sum())]
+    executor = None
+
+    try:
+        while max_rounds is None or len(round_scores) <= max_rounds:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+
+            blocks = []
+            for start, stop in find_blocks(np.flatnonzero(conserved).tolist(), aligned_seqs.length):
+                block = aligned_seqs.block(start, stop)
+                key = (block.data.shape, block.data.tobytes())
+                if key not in checked_blocks:
+                    blocks.append((start, stop, key, block))
+            if not blocks:
+                break
+
+            block_seqs = [aligned_seqs.degapped_block(start, stop) for start, stop, _, _ in blocks]
+            if processes == 1 or len(blocks) < PARALLEL_BLOCKS:
+                results = list(map(realign_block, block_seqs))
+            else:
+                if executor is None:
+                    executor = concurrent.futures.ProcessPoolExecutor(processes)
+                results = list(executor.map(realign_block, block_seqs))
+
+            # Splice right to left so the column indexes of the remaining blocks stay valid
+            improved = False
+            for (start, stop, key, block), (new_block, new_score) in reversed(list(zip(blocks, results))):
+                if new_score > scores[start:stop].sum():
+                    improved = True
+                    aligned_seqs = aligned_seqs.replace_block(start, stop, new_block)
+                    scores = rescore_block(scores, start, stop, new_block, S_MATCH, S_MISSMATCH, S_GAP)
+                    conserved = np.concatenate([conserved[:start], conserved_columns(new_block.data),
+                                                conserved[stop:]])
+                else:
+                    checked_blocks.add(key)
+
+            if not improved:
+                break
+            round_scores.append(int(scores.sum()))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return aligned_seqs, round_scores
@@ -1,143 +1,255 @@
-import itertools
-import math
+import argparse
+import struct
 
-PSEUDOCOUNT = 2
+import numpy as np
 
+import shared_path
+import instrument
 
-def calculate_columns(seqs):
-    columns = []
-    for i in range(len(seqs[0])):
-        columns.append([])
-        for seq in seqs:
-            columns[i].append(seq[i])
-    return columns
-
-
-def calculate_scores():
-    for i in range(len(input_seqs[0])):
-        # print('\n', i)
-        score_matrix[i] = {}
-        for char in alphabet:
-            char_frequency = seq_columns[i].count(char)
-            # print(char_frequency)
-            score = (char_frequency + PSEUDOCOUNT) / (len(input_seqs) + len(alphabet) * PSEUDOCOUNT)
-            score_matrix[i][char] = score
-
-    char_sum = {}
-    for char in alphabet:
-        char_sum[char] = 0
-    for index in score_matrix:
-        for char in score_matrix[index]:
-            char_sum[char] += score_matrix[index][char]
-
-    for index in score_matrix:
-        for char in alphabet:
-            last_score = score_matrix[index][char]
-            score_matrix[index][char] = math.log2(last_score / (char_sum.get(char) / 5))
-
-
-def insert_gaps(word, length, checked_words):
-    if len(word) >= length:
-        # print([word])
-        return [word]
-    words = []
-    for i in range(len(word) + 1):
-        new_word = word[:i] + '-' + word[i:]
-        # words.append(new_word)
-        if new_word not in checked_words:
-            checked_words.append(new_word)
-            words += insert_gaps(new_word, length, checked_words)
-        # else:
-        #     print(word)
-    # print(words)
-    words = list(dict.fromkeys(words))
-    return words
+PSEUDOCOUNT = 2
+PROFILE_MAGIC = b'PSSM'
+PROFILE_HEADER = '<IIId'
+# Shortest query window the search considers, and the score a match has to beat
+MIN_WORD_LENGTH = 3
+MIN_SCORE = -1000
+
+
+# Position-specific scoring matrix of an MSA. counts[k, c] is how often alphabet[c] occurs in
+# column k (gaps included as a symbol), log_odds[k, c] = log2(frequency / background[c]) with
+#   frequency = (count + pseudocount) / (number of sequences + alphabet size * pseudocount)
+# and the background defaulting to each symbol's mean frequency over all columns.
+class Profile:
+    def __init__(self, alphabet, counts, num_seqs, pseudocount=PSEUDOCOUNT, background=None):
+        self.alphabet = alphabet
+        self.counts = np.asarray(counts, dtype=np.uint32)
+        self.num_seqs = num_seqs
+        self.pseudocount = pseudocount
+
+        self.frequencies = (self.counts + pseudocount) / (num_seqs + len(alphabet) * pseudocount)
+        if background is None:
+            self.background = self.frequencies.mean(axis=0)
+        elif isinstance(background, dict):
+            self.background = np.array([background[char] for char in alphabet], dtype=np.float64)
+        else:
+            self.background = np.asarray(background, dtype=np.float64)
+        self.log_odds = np.log2(self.frequencies / self.background)
+
+    # seqs are the aligned rows; the alphabet is every symbol in them, in order of first appearance
+    @classmethod
+    def from_alignment(cls, seqs, pseudocount=PSEUDOCOUNT, background=None):
+        length = len(seqs[0])
+        data = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8).reshape(len(seqs), length)
+
+        symbols, first = np.unique(data, return_index=True)
+        symbols = symbols[np.argsort(first)]
+        codes = np.zeros(256, dtype=np.intp)
+        codes[symbols] = np.arange(len(symbols))
+
+        # One bincount over (column, symbol) cells of the whole alignment
+        cells = codes[data] + len(symbols) * np.arange(length)
+        counts = np.bincount(cells.ravel(), minlength=length * len(symbols)).reshape(length, len(symbols))
+        return cls(symbols.tobytes().decode(), counts, len(seqs), pseudocount, background)
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    # Scores of every profile column for one symbol, -inf for symbols the MSA never used
+    def symbol_scores(self, char):
+        index = self.alphabet.find(char)
+        if index < 0:
+            return np.full(len(self), -np.inf)
+        return self.log_odds[:, index]
+
+    # Layout: PROFILE_MAGIC, header (columns, alphabet size, sequences, pseudocount), alphabet bytes,
+    # uint32 counts (columns x alphabet), float64 background and float64 log-odds, all little-endian.
+    # The log-odds are stored so that loading is just a few buffer views.
+    def save(self, path):
+        header = struct.pack(PROFILE_HEADER, len(self), len(self.alphabet), self.num_seqs, self.pseudocount)
+        with open(path, 'wb') as file:
+            file.write(PROFILE_MAGIC + header + self.alphabet.encode())
+            file.write(self.counts.astype('<u4').tobytes())
+            file.write(self.background.astype('<f8').tobytes())
+            file.write(self.log_odds.astype('<f8').tobytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            buffer = file.read()
+        if buffer[:len(PROFILE_MAGIC)] != PROFILE_MAGIC:
+            raise ValueError(f'{path} is not a profile file')
+
+        offset = len(PROFILE_MAGIC)
+        length, size, num_seqs, pseudocount = struct.unpack_from(PROFILE_HEADER, buffer, offset)
+        offset += struct.calcsize(PROFILE_HEADER)
+        alphabet = buffer[offset:offset + size].decode()
+        offset += size
+
+        counts = np.frombuffer(buffer, dtype='<u4', count=length * size, offset=offset).reshape(length, size)
+        offset += counts.nbytes
+        background = np.frombuffer(buffer, dtype='<f8', count=size, offset=offset)
+        offset += background.nbytes
+        log_odds = np.frombuffer(buffer, dtype='<f8', count=length * size, offset=offset).reshape(length, size)
+
+        profile = cls.__new__(cls)
+        profile.alphabet = alphabet
+        profile.counts = counts
+        profile.num_seqs = num_seqs
+        profile.pseudocount = pseudocount
+        profile.frequencies = (counts + pseudocount) / (num_seqs + size * pseudocount)
+        profile.background = background
+        profile.log_odds = log_odds
+        return profile
+
+
+def profile_arrays(profile, search_seq):
+    gap_scores = profile.symbol_scores('-')
+    chars = sorted(set(search_seq))
+    char_scores = np.array([profile.symbol_scores(char) for char in chars]).T
+    codes = {char: code for code, char in enumerate(chars)}
+    query = np.array([codes[char] for char in search_seq], dtype=np.intp)
+    return gap_scores, char_scores.reshape(len(profile), len(chars)), query
+
+
+# Best gapped placement of a substring of search_seq on the profile, by dynamic programming over
+# (profile column, query position) in O(|profile| * |query|) time and O(|query|) memory. A state is
+# the best placement of a word ending at query position p on the columns seen so far; the word's start
+# is free, so its length is carried along as a tie-break value instead of being a DP axis. Words of
+# one and two characters have states of their own, which also keeps words shorter than
+# MIN_WORD_LENGTH out of the result. Ties are broken like the enumeration did: the longest word, then
+# the leftmost one, then the case that puts gaps as early as possible. Sums are added column by column,
+# so each one is the same float the enumeration added up; only when two words' sums become equal
+# through rounding after one was ahead by the last bit can the shorter one be kept. Returns
+# ('', MIN_SCORE) when no word beats MIN_SCORE.
+def search_profile(profile, search_seq):
+    length = len(profile)
+    n = len(search_seq)
+    if length < MIN_WORD_LENGTH or n < MIN_WORD_LENGTH:
+        return '', MIN_SCORE
+    gap_scores, char_scores, query = profile_arrays(profile, search_seq)
+
+    # Scores by query end p of words of exactly one and two characters, and of longer words (with their
+    # lengths); the word of no characters has the same score (all gaps) at every p
+    empty = 0.0
+    one = np.full(n + 1, -np.inf)
+    two = np.full(n + 1, -np.inf)
+    longer = np.full(n + 1, -np.inf)
+    longer_lengths = np.zeros(n + 1, dtype=np.int64)
+
+    for k in range(length):
+        chars = char_scores[k][query]
+        gap = gap_scores[k]
+
+        # Longer words either get a gap, take the next character, or are two-character words that
+        # take their third; on equal scores the longer word wins
+        taken = longer[:-1] + chars
+        third = two[:-1] + chars
+        use_taken = taken >= third
+        extended = np.where(use_taken, taken, third)
+        extended_lengths = np.where(use_taken, longer_lengths[:-1] + 1, MIN_WORD_LENGTH)
+        gapped = longer[1:] + gap
+        use_gap = (gapped > extended) | ((gapped == extended) & (longer_lengths[1:] > extended_lengths))
+        longer[1:] = np.where(use_gap, gapped, extended)
+        longer_lengths[1:] = np.where(use_gap, longer_lengths[1:], extended_lengths)
+        longer[0] += gap
+
+        two[1:] = np.maximum(two[1:] + gap, one[:-1] + chars)
+        two[0] += gap
+        one[1:] = np.maximum(one[1:] + gap, empty + chars)
+        one[0] += gap
+        empty += gap
+    instrument.count('cells', length * n)
+
+    max_score = longer.max()
+    if not max_score > MIN_SCORE:
+        return '', MIN_SCORE
+
+    # Longest word among the best, then the leftmost (argmax takes the first end)
+    tied = longer == max_score
+    word_length = int(longer_lengths[tied].max())
+    end = int(np.argmax(tied & (longer_lengths == word_length)))
+    start = end - word_length
+
+    instrument.record('tied_windows', int(tied.sum()))
+    with instrument.stage('place_word'):
+        return place_word(length, search_seq[start:end], gap_scores, char_scores, query[start:])
+
+
+# Best placement of word on the profile, decided the way the enumeration decided it: by the float
+# sum added up column by column (which is not associative, so placements can differ in the last bit),
+# and among exactly equal sums by the case that puts gaps first. Each (column, characters placed)
+# state keeps every prefix sum close enough to its best to still end on the maximum, with its
+# predecessors; the earliest-gap path to the maximum is then read off front to back.
+def place_word(length, word, gap_scores, char_scores, query):
+    word_chars = char_scores[:, query[:len(word)]]
+
+    # states[k][u]: {prefix sum of the first k columns holding word[:u]: [(previous sum, took a character)]}
+    states = [[{} for _ in range(len(word) + 1)] for _ in range(length + 1)]
+    states[0][0][0] = []
+    for k in range(length):
+        for u in range(max(0, len(word) - length + k), min(k, len(word)) + 1):
+            for value in states[k][u]:
+                states[k + 1][u].setdefault(value + gap_scores[k], []).append((value, False))
+                if u < len(word):
+                    states[k + 1][u + 1].setdefault(value + word_chars[k, u], []).append((value, True))
+        for u in range(len(word) + 1):
+            values = states[k + 1][u]
+            if values:
+                best = max(values)
+                tolerance = 1e-9 * max(1.0, abs(best))
+                states[k + 1][u] = {value: moves for value, moves in values.items() if value >= best - tolerance}
+
+    max_score = max(states[length][len(word)])
+    reachable = {(length, len(word), max_score)}
+    for k in range(length, 0, -1):
+        for u in range(len(word) + 1):
+            for value, moves in states[k][u].items():
+                if (k, u, value) in reachable:
+                    for previous, took_char in moves:
+                        reachable.add((k - 1, u - took_char, previous))
+
+    case = ''
+    value = 0
+    for k in range(length):
+        used = len(case) - case.count('-')
+        if (k + 1, used, value + gap_scores[k]) in reachable:
+            case += '-'
+            value += gap_scores[k]
+        else:
+            case += word[used]
+            value += word_chars[k, used]
+
+    return case, float(max_score)
 
 
 if __name__ == '__main__':
-    input_seqs = []
-    alphabet = {}
-    score_matrix = {}
-    number_of_seqs = int(input())
-
-    for i in range(number_of_seqs):
-        input_seq = input()
-        input_seqs.append(input_seq)
-
-        for char in input_seq:
-            if char not in alphabet:
-                alphabet[char] = 1
-            else:
-                alphabet[char] += 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pseudocount', type=float, default=PSEUDOCOUNT)
+    parser.add_argument('--save-profile', metavar='PATH', help='write the profile built from the MSA to PATH')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='search with a saved profile; the input is then only the search sequence')
+    parser.add_argument('--stats', nargs='?', const='-', metavar='FILE',
+                        help='write stage timings and counts as JSON to FILE (stderr if no FILE is given)')
+    args = parser.parse_args()
+    if args.stats:
+        instrument.enable()
+
+    if args.profile:
+        with instrument.stage('profile'):
+            profile = Profile.load(args.profile)
+    else:
+        number_of_seqs = int(input())
+        input_seqs = [input() for _ in range(number_of_seqs)]
+        with instrument.stage('profile'):
+            profile = Profile.from_alignment(input_seqs, args.pseudocount)
+        if args.save_profile:
+            profile.save(args.save_profile)
 
     search_seq = input()
-    seq_columns = calculate_columns(input_seqs)
-    calculate_scores()
-
-    # print(input_seqs)
-    # print(search_seq)
-    # print(alphabet)
-    # print(seq_columns)
-
-    cases = []
-    max_word = ''
-    max_score = -1000
-    # for j in range(len(input_seqs[0])-1, -1, -1):
-    #     word = search_seq[i:i + j + 1]
-    index = 0
-    for j in range(len(input_seqs[0]), 2, -1):
-        checked_words = []
-        for i in range(len(search_seq) - j + 1):
-            word = search_seq[i:i + j]
-            if word not in checked_words:
-                # cases = insert_gaps(word, len(input_seqs[0]), [])
-                if len(word) == len(input_seqs[0]):
-                    cases = [word]
-                else:
-                    cases = insert_gaps(word, len(input_seqs[0]), [])
-                checked_words.append(word)
-
-                for case in cases:
-                    score = 0
-                    for k in range(len(case)):
-                        score += score_matrix[k][case[k]]
-                    if score > max_score:
-                        # print(case)
-                        max_score = score
-                        max_word = case
-
-
-            # else:
-            # print(cases)
-            # else:
-            #     print(cases)
-            #     print(word)
-
-            # for k in range(len(input_seqs[0]) - len(word)):
-            #     word += '-'
-            # print(word)
-            # words = list(map("".join, itertools.combinations(word,len(word))))
-            # print(words)
-            # cases += words
-
-    # cases = list(dict.fromkeys(cases))
-    # print(cases)
-
-    # max_word = ''
-    # max_score = -1000
-    #
-    # for case in cases:
-    #     score = 0
-    #     for i in range(len(case)):
-    #         score += score_matrix[i][case[i]]
-    #     if score > max_score:
-    #         max_score = score
-    #         max_word = case
+    with instrument.stage('search'):
+        max_word, max_score = search_profile(profile, search_seq)
     print(max_word)
 
-    # print(cases)
-    # print()
-
-    # for temp in score_matrix:
-    #     print(temp)
-    #     print('', score_matrix[temp])
+    instrument.record('profile_columns', len(profile))
+    instrument.record('query_length', len(search_seq))
+    instrument.record('score', max_score)
+    instrument.emit(args.stats)
@@ -0,0 +1,166 @@
+import argparse
+import concurrent.futures
+import heapq
+import os
+
+from Profile import PROFILE_MAGIC, Profile, search_profile
+
+import shared_path
+from seq_store import SequenceStore, is_store, read_records
+
+TOP_HITS = 10
+# Database sequences per shard; a shard is the unit of work of one worker and of streamed output
+SHARD_SIZE = 256
+
+worker_profiles = []
+
+
+# The database: a sequence store (opened, not read) or the (id, sequence) records of a FASTA file
+def read_database(path):
+    return SequenceStore(path) if is_store(path) else ((seq_id, seq) for seq_id, _, seq in read_records(path))
+
+
+# A profile saved by Profile.py --save-profile, or an MSA file (aligned FASTA, or one row per line)
+def read_profile(path):
+    with open(path, 'rb') as file:
+        if file.read(len(PROFILE_MAGIC)) == PROFILE_MAGIC:
+            return Profile.load(path)
+
+    with open(path) as file:
+        lines = [line.strip() for line in file if line.strip()]
+    if lines[0].startswith('>'):
+        seqs = [seq for _, _, seq in read_records(path)]
+    else:
+        seqs = lines[1:] if lines[0].isdigit() else lines
+    return Profile.from_alignment(seqs)
+
+
+def shards(records, shard_size=SHARD_SIZE):
+    shard = []
+    for record in records:
+        shard.append(record)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def init_worker(profiles):
+    global worker_profiles
+    worker_profiles = profiles
+
+
+# Best hits of every profile within one shard: lists of (score, database index, id, match),
+# best first. first is the database index of the shard's first sequence.
+def scan_shard(shard, first, top=TOP_HITS):
+    heaps = [[] for _ in worker_profiles]
+    for index, (seq_id, seq) in enumerate(shard, first):
+        for heap, profile in zip(heaps, worker_profiles):
+            match, score = search_profile(profile, seq)
+            if match:
+                push_hit(heap, (score, index, seq_id, match), top)
+    return [ranked(heap) for heap in heaps]
+
+
+# heap holds the top hits as a min-heap of (score, -index, ...), so on equal scores
+# the sequence earlier in the database wins
+def push_hit(heap, hit, top):
+    score, index, seq_id, match = hit
+    entry = (score, -index, seq_id, match)
+    if len(heap) < top:
+        heapq.heappush(heap, entry)
+    elif heap and entry > heap[0]:
+        heapq.heapreplace(heap, entry)
+
+
+# Runs in a worker: scan_shard over the sequences first .. stop - 1 of a sequence store, read by the
+# worker from the memory-mapped file instead of being sent by the parent process
+def scan_store_shard(path, first, stop, top=TOP_HITS):
+    store = SequenceStore(path)
+    return scan_shard([(store.name(index), store[index]) for index in range(first, stop)], first, top)
+
+
+# Work of every shard as (function, arguments, shard size)
+def shard_jobs(records, shard_size, top):
+    if isinstance(records, SequenceStore):
+        for first in range(0, len(records), shard_size):
+            stop = min(first + shard_size, len(records))
+            yield scan_store_shard, (records.path, first, stop, top), stop - first
+    else:
+        first = 0
+        for shard in shards(records, shard_size):
+            yield scan_shard, (shard, first, top), len(shard)
+            first += len(shard)
+
+
+def ranked(heap):
+    return [(score, -index, seq_id, match) for score, index, seq_id, match in sorted(heap, reverse=True)]
+
+
+# Scans the database with every profile, yielding (first index, shard size, hits per profile) as shards
+# finish (not necessarily in database order), followed by (None, total, final top hits per profile).
+# The database is read lazily with at most a few shards per worker in flight; records may also be a
+# SequenceStore, whose shards the workers read themselves.
+def scan_database(profiles, records, top=TOP_HITS, processes=None, shard_size=SHARD_SIZE):
+    heaps = [[] for _ in profiles]
+    total = 0
+
+    def merge(first, size, hits):
+        for heap, profile_hits in zip(heaps, hits):
+            for hit in profile_hits:
+                push_hit(heap, hit, top)
+        return first, size, hits
+
+    if processes == 1:
+        init_worker(profiles)
+        for function, job, size in shard_jobs(records, shard_size, top):
+            yield merge(total, size, function(*job))
+            total += size
+    else:
+        max_pending = 2 * (processes or os.cpu_count() or 1)
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=init_worker,
+                                                    initargs=(profiles,)) as executor:
+            pending = {}
+            for function, job, size in shard_jobs(records, shard_size, top):
+                pending[executor.submit(function, *job)] = (total, size)
+                total += size
+                while len(pending) >= max_pending:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield merge(*pending.pop(future), future.result())
+            for future in concurrent.futures.as_completed(list(pending)):
+                yield merge(*pending.pop(future), future.result())
+
+    yield None, total, [ranked(heap) for heap in heaps]
+
+
+def print_hits(name, hits):
+    for score, index, seq_id, match in hits:
+        print(f'{name}\t{seq_id}\t{score:.3f}\t{match}', flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('database', help='FASTA file or sequence store of the sequences to scan')
+    parser.add_argument('profiles', nargs='+', help='profiles saved with Profile.py --save-profile, or MSA files')
+    parser.add_argument('--top', type=int, default=TOP_HITS, help='hits reported per profile')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    parser.add_argument('--no-stream', action='store_true', help='only print the final top hits')
+    args = parser.parse_args()
+    if args.top < 1:
+        parser.error('--top must be at least 1')
+
+    names = [os.path.splitext(os.path.basename(path))[0] for path in args.profiles]
+    profiles = [read_profile(path) for path in args.profiles]
+
+    # Shard results stream out as they finish; the final ranking over the whole database comes last
+    for first, size, hits in scan_database(profiles, read_database(args.database), args.top, args.processes,
+                                           args.shard_size):
+        if first is not None and args.no_stream:
+            continue
+        print(f'# shard {first}-{first + size - 1}' if first is not None else f'# top hits of {size} sequences',
+              flush=True)
+        for name, profile_hits in zip(names, hits):
+            print_hits(name, profile_hits)
@@ -0,0 +1,225 @@
+import argparse
+import sys
+
+import numpy as np
+
+GAP = ord('-')
+# A column becomes a match state when at most this fraction of its rows are gaps
+MATCH_GAP_FRACTION = 0.5
+PSEUDOCOUNT = 1
+# Queries scored together; every step of the recursion is one NumPy update of (batch x model) cells
+BATCH_SIZE = 256
+
+# Transitions out of node j, in the order of ProfileHMM.transitions[:, t]: from state M/I/D of
+# node j to M/I/D of node j + 1 (I -> I stays in node j). Node 0 is the begin state (as M0).
+MM, MI, MD, IM, II, ID, DM, DI, DD = range(9)
+MATCH = 0
+INSERT = 1
+DELETE = 2
+
+
+# Profile HMM (match, insert and delete states per node) estimated from an MSA the way Durbin et al.
+# describe it: columns with few gaps are match states, every row is a path through the model, and
+# emissions and transitions are its counts plus PSEUDOCOUNT. Scores are log2 odds against a background
+# model of the MSA's residue frequencies, so insert states (which emit the background) score 0.
+class ProfileHMM:
+    def __init__(self, alphabet, match_emissions, transitions):
+        self.alphabet = alphabet
+        self.match_emissions = match_emissions
+        self.transitions = transitions
+        self.codes = np.full(256, len(alphabet), dtype=np.intp)
+        self.codes[np.frombuffer(alphabet.encode(), dtype=np.uint8)] = np.arange(len(alphabet))
+
+    @classmethod
+    def from_alignment(cls, seqs, gap_fraction=MATCH_GAP_FRACTION, pseudocount=PSEUDOCOUNT):
+        data = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8).reshape(len(seqs), len(seqs[0]))
+        residues = data != GAP
+        alphabet = np.unique(data[residues])
+        codes = np.zeros(256, dtype=np.intp)
+        codes[alphabet] = np.arange(len(alphabet))
+
+        match_columns = np.flatnonzero((~residues).mean(axis=0) <= gap_fraction)
+        length = len(match_columns)
+        # node[c]: the match node of column c, or the node whose insert state column c belongs to
+        node = np.cumsum(np.isin(np.arange(data.shape[1]), match_columns))
+        is_match = np.zeros(data.shape[1], dtype=bool)
+        is_match[match_columns] = True
+
+        emission_counts = np.zeros((length + 1, len(alphabet)))
+        match_data = data[:, match_columns]
+        for k in range(length):
+            column = match_data[:, k]
+            emission_counts[k + 1] = np.bincount(codes[column[column != GAP]], minlength=len(alphabet))
+
+        # Each row visits one state per match column (M or D) and one I state per residue in between
+        transition_counts = np.zeros((length + 1, 9))
+        for row, row_residues in zip(data, residues):
+            state, state_node = MATCH, 0
+            for column in range(data.shape[1]):
+                if is_match[column]:
+                    next_state = MATCH if row_residues[column] else DELETE
+                elif row_residues[column]:
+                    next_state = INSERT
+                else:
+                    continue
+                transition_counts[state_node, 3 * state + next_state] += 1
+                state, state_node = next_state, node[column]
+            transition_counts[state_node, 3 * state + MATCH] += 1
+
+        background = np.bincount(codes[data[residues]], minlength=len(alphabet)) + pseudocount
+        background = background / background.sum()
+        emissions = emission_counts + pseudocount
+        emissions /= emissions.sum(axis=1, keepdims=True)
+        # The last column scores residues the MSA never used like the background
+        match_emissions = np.zeros((len(alphabet) + 1, length + 1))
+        match_emissions[:-1, 1:] = np.log2(emissions[1:] / background).T
+
+        transitions = (transition_counts + pseudocount).reshape(length + 1, 3, 3)
+        transitions = np.log2(transitions / transitions.sum(axis=2, keepdims=True)).reshape(length + 1, 9)
+        # There is no D0 state
+        transitions[0, DM:] = -np.inf
+        return cls(alphabet.tobytes().decode(), match_emissions, transitions)
+
+    def __len__(self):
+        return self.match_emissions.shape[1] - 1
+
+    def encode(self, seq):
+        return self.codes[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+    # Best path score, the path (see trace_back) and the query span it aligns
+    def viterbi(self, seq, local=False):
+        codes = self.encode(seq)[np.newaxis, :]
+        pointers = []
+        score, end = recursion(self, codes, np.array([len(seq)]), False, local, pointers)
+        alignment, start, end = trace_back(seq, pointers, int(end[0]), len(self))
+        return float(score[0]), alignment, (start, end)
+
+    def forward(self, seq, local=False):
+        codes = self.encode(seq)[np.newaxis, :]
+        score, _ = recursion(self, codes, np.array([len(seq)]), True, local)
+        return float(score[0])
+
+    # Viterbi (or Forward) scores of many queries, batched by length so that the recursion
+    # runs over (batch x model) arrays and short queries do not wait on long ones
+    def score_batch(self, seqs, forward=False, local=False, batch_size=BATCH_SIZE):
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.intp)
+        scores = np.empty(len(seqs))
+        order = np.argsort(lengths, kind='stable')
+
+        for start in range(0, len(seqs), batch_size):
+            batch = order[start:start + batch_size]
+            codes = np.full((len(batch), lengths[batch].max()), len(self.alphabet), dtype=np.intp)
+            for row, index in enumerate(batch):
+                codes[row, :lengths[index]] = self.encode(seqs[index])
+            scores[batch], _ = recursion(self, codes, lengths[batch], forward, local)
+        return scores
+
+
+# Log-space Viterbi (max) or Forward (log-sum-exp) over a batch of encoded queries, one query position
+# per step and all nodes at once. M and I of a step only need the previous step; D runs along the nodes
+# of the same step, D[j] = max(a[j], D[j - 1] + dd[j - 1]), which is unrolled with a prefix maximum
+# (a prefix log-sum-exp for Forward) over a[k] - C[k], where C is the running sum of the D -> D scores.
+# In local mode the query may have unaligned residues on both sides for free; the model is still
+# aligned end to end. Returns the end scores and the query position each alignment ends at. When
+# pointers is a list it receives the (M, I, D, end) traceback of every step (for a batch of one).
+def recursion(model, codes, lengths, forward, local, pointers=None):
+    batch, length = len(codes), len(model)
+    # float32 is plenty for log odds and halves the memory traffic of every step
+    t = model.transitions.astype(np.float32)
+    emissions = model.match_emissions[:, 1:].astype(np.float32)
+    combine = np.logaddexp2 if forward else np.maximum
+    accumulate = np.logaddexp2.accumulate if forward else np.maximum.accumulate
+    dd = np.concatenate([[0], np.cumsum(t[1:-1, DD])]).astype(np.float32)
+
+    m = np.full((batch, length + 1), -np.inf, dtype=np.float32)
+    i = np.full((batch, length + 1), -np.inf, dtype=np.float32)
+    m[:, 0] = 0
+    scores = np.full(batch, -np.inf)
+    ends = np.zeros(batch, dtype=np.intp)
+
+    for position in range(codes.shape[1] + 1):
+        if position:
+            to_m = (m[:, :-1] + t[:-1, MM], i[:, :-1] + t[:-1, IM], d[:, :-1] + t[:-1, DM])
+            to_i = (m + t[:, MI], i + t[:, II], d + t[:, DI])
+            m = np.empty_like(m)
+            m[:, 1:] = combine(combine(*to_m[:2]), to_m[2]) + emissions[codes[:, position - 1]]
+            m[:, 0] = 0 if local else -np.inf
+            i = combine(combine(*to_i[:2]), to_i[2])
+
+        to_d = (m[:, :-1] + t[:-1, MD], i[:, :-1] + t[:-1, ID])
+        opened = combine(*to_d)
+        d = np.full((batch, length + 1), -np.inf, dtype=np.float32)
+        d[:, 1:] = accumulate(opened - dd, axis=1) + dd
+
+        to_end = (m[:, -1] + t[-1, MM], i[:, -1] + t[-1, IM], d[:, -1] + t[-1, DM])
+        end = combine(combine(*to_end[:2]), to_end[2])
+
+        if pointers is not None:
+            extended = np.full((batch, length), -np.inf)
+            extended[:, 1:] = d[:, 1:-1] + t[1:-1, DD]
+            pointers.append((best_state(*to_m) if position else None, best_state(*to_i) if position else None,
+                             best_state(*to_d, extended), best_state(*to_end)))
+
+        if local:
+            live = position <= lengths
+            ends[live & (end > scores)] = position
+            scores[live] = combine(scores[live], end[live])
+        else:
+            done = lengths == position
+            scores[done] = end[done]
+            ends[done] = position
+
+    return scores, ends
+
+
+# Source state (MATCH, INSERT or DELETE) of the first row of a batch, the first one on ties
+def best_state(from_m, from_i, from_d):
+    best = np.where(from_i[0] > from_m[0], INSERT, MATCH)
+    return np.where(from_d[0] > np.maximum(from_m[0], from_i[0]), DELETE, best)
+
+
+# Viterbi path as one string over the model: the residue of every match state, '-' for delete
+# states and inserted residues in lowercase. Returns it with the query span [start, end) it covers.
+def trace_back(seq, pointers, end, length):
+    path = []
+    position, node = end, length
+    state = int(pointers[end][3])
+
+    while state != MATCH or node > 0:
+        m_from, i_from, d_from, _ = pointers[position]
+        if state == MATCH:
+            path.append(seq[position - 1])
+            state = int(m_from[node - 1])
+            position, node = position - 1, node - 1
+        elif state == INSERT:
+            path.append(seq[position - 1].lower())
+            state = int(i_from[node])
+            position -= 1
+        else:
+            path.append('-')
+            state = int(d_from[node - 1])
+            node -= 1
+
+    return ''.join(reversed(path)), position, end
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--forward', action='store_true', help='Forward (all paths) instead of Viterbi scores')
+    parser.add_argument('--local', action='store_true', help='let queries have unaligned residues on both ends')
+    parser.add_argument('--align', action='store_true', help='also print the Viterbi path of every query')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    # Same MSA input as Profile.py, followed by any number of query lines
+    number_of_seqs = int(input())
+    input_seqs = [input() for _ in range(number_of_seqs)]
+    queries = [line.strip() for line in sys.stdin if line.strip()]
+
+    model = ProfileHMM.from_alignment(input_seqs)
+    scores = model.score_batch(queries, args.forward, args.local, args.batch_size)
+    for query, score in zip(queries, scores):
+        if args.align:
+            print(f'{score:.3f}', model.viterbi(query, args.local)[1])
+        else:
+            print(f'{score:.3f}')
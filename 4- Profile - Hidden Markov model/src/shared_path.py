@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Importing this module makes the code shared by the projects (instrument, seq_store), which lives in
+# the repository's shared directory, importable from the scripts of this project
+SHARED = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'shared'))
+if SHARED not in sys.path:
+    sys.path.append(SHARED)
@@ -0,0 +1,134 @@
+import argparse
+import hashlib
+import os
+import sys
+
+import joblib
+import numpy as np
+from sklearn.neural_network import MLPClassifier
+
+from feature_pipeline import CHUNK_SIZE, chunks, featurize_file, label_code
+from kmer_features import AMBIGUOUS_POLICIES, featurize
+
+import shared_path
+from seq_store import parse_records
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'virus-classifier')
+# Bump when the features of a given file and k change, so stale cache entries are not reused
+CACHE_VERSION = 2
+# Sequences predicted per batch
+BATCH_SIZE = 4096
+# The notebook's model
+HIDDEN_LAYERS = (64, 64, 64)
+MAX_ITER = 2000
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Features (memory-mapped) and label names of a CSV/FASTA file, computed once per file content, k and
+# ambiguous policy and then loaded from cache_dir. The names are cached rather than their codes, which
+# depend on the label map they are encoded with (see encode_labels).
+def cached_features(path, k, ambiguous='skip', cache_dir=CACHE_DIR, processes=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    key = os.path.join(cache_dir, f'{file_hash(path)}-k{k}-{ambiguous}-v{CACHE_VERSION}')
+    features_path, labels_path = key + '.npy', key + '.labels.npy'
+
+    if not os.path.exists(features_path):
+        # Written under a temporary name so an interrupted run leaves no half-written entry behind
+        partial = key + '.partial.npy'
+        _, labels, label_map = featurize_file(path, partial, k, ambiguous, processes, CHUNK_SIZE)
+        if labels is not None:
+            names = {code: label for label, code in label_map.items()}
+            codes, rows = np.unique(labels, return_inverse=True)
+            np.save(labels_path, np.array([names[code] for code in codes.tolist()])[rows])
+        os.replace(partial, features_path)
+
+    labels = np.load(labels_path) if os.path.exists(labels_path) else None
+    return np.load(features_path, mmap_mode='r'), labels
+
+
+# Codes of label names under label_map, which gets the labels it does not have yet (in order of
+# first appearance)
+def encode_labels(names, label_map):
+    distinct, firsts, rows = np.unique(names, return_index=True, return_inverse=True)
+    codes = np.zeros(len(distinct), dtype=np.int32)
+    for index in np.argsort(firsts):
+        codes[index] = label_code(str(distinct[index]), label_map)
+    return codes[rows]
+
+
+# Fits the model and saves it with its featurization parameters and the label map of the training
+# set, which predict and the development accuracy decode and encode labels with
+def train(path, model_path, k=2, ambiguous='skip', cache_dir=CACHE_DIR, processes=None):
+    features, names = cached_features(path, k, ambiguous, cache_dir, processes)
+    if names is None:
+        raise ValueError(f'{path} has no Type column to train on')
+
+    label_map = {}
+    labels = encode_labels(names, label_map)
+    model = MLPClassifier(hidden_layer_sizes=HIDDEN_LAYERS, activation='relu', random_state=1, max_iter=MAX_ITER)
+    model.fit(np.asarray(features), labels)
+    bundle = {'model': model, 'k': k, 'ambiguous': ambiguous, 'label_map': label_map}
+    joblib.dump(bundle, model_path)
+    return bundle
+
+
+# Sequences of stdin: one per line (after an optional Sequence header), or a FASTA stream
+def read_stdin():
+    return (seq for _, _, seq in parse_records(sys.stdin))
+
+
+# Predicted label names, one list per batch. Files go through the feature cache; stdin is
+# featurized batch by batch as it arrives.
+def predict(bundle, inputs, cache_dir=CACHE_DIR, processes=None, batch_size=BATCH_SIZE):
+    model, k, ambiguous = bundle['model'], bundle['k'], bundle['ambiguous']
+    names = {code: label for label, code in bundle['label_map'].items()}
+    for path in inputs:
+        if path == '-':
+            for batch in chunks(read_stdin(), batch_size):
+                yield [names[code] for code in model.predict(featurize(batch, k, ambiguous)).tolist()]
+        else:
+            features, _ = cached_features(path, k, ambiguous, cache_dir, processes)
+            for start in range(0, len(features), batch_size):
+                yield [names[code] for code in model.predict(np.asarray(features[start:start + batch_size])).tolist()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='where features are cached by file hash and k')
+    parser.add_argument('--processes', type=int, default=None)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = commands.add_parser('train', help='fit the MLP on a labeled CSV and save it')
+    train_parser.add_argument('input', help='CSV with Type and Sequence columns')
+    train_parser.add_argument('model', help='file the model and its featurization parameters are saved to')
+    train_parser.add_argument('-k', type=int, default=2)
+    train_parser.add_argument('--ambiguous', choices=AMBIGUOUS_POLICIES, default='skip')
+    train_parser.add_argument('--dev', help='labeled CSV to report the accuracy on')
+
+    predict_parser = commands.add_parser('predict', help='classify sequences with a saved model')
+    predict_parser.add_argument('model')
+    predict_parser.add_argument('inputs', nargs='*', default=['-'],
+                                help="CSV/FASTA files, or - for sequences on stdin (the default)")
+    predict_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        bundle = train(args.input, args.model, args.k, args.ambiguous, args.cache_dir, args.processes)
+        if args.dev:
+            features, names = cached_features(args.dev, args.k, args.ambiguous, args.cache_dir, args.processes)
+            if names is None:
+                raise ValueError(f'{args.dev} has no Type column to score against')
+            # Labels the training set did not have get new codes, which the model never predicts
+            labels = encode_labels(names, dict(bundle['label_map']))
+            print(f'development accuracy: {bundle["model"].score(np.asarray(features), labels):.4f}', file=sys.stderr)
+    else:
+        bundle = joblib.load(args.model)
+        for predictions in predict(bundle, args.inputs, args.cache_dir, args.processes, args.batch_size):
+            sys.stdout.write(''.join(f'{prediction}\n' for prediction in predictions))
@@ -0,0 +1,157 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+from kmer_features import AMBIGUOUS_POLICIES, featurize
+
+import shared_path
+from seq_store import SequenceStore, is_store, read_records, text_format
+
+# Sequences per chunk: the unit of reading, of work for one worker and of writes to the output
+CHUNK_SIZE = 2048
+# Labels with a number at the end (Class1 ... Class6) map to that number
+LABEL_NUMBER = re.compile(r'(\d+)$')
+
+
+# Records in a file, counted over its raw lines before the real pass: FASTA header lines, or non-empty
+# lines (after the header of a CSV file); a sequence store knows its size
+def count_records(path):
+    if is_store(path):
+        return len(SequenceStore(path))
+    with open(path, newline='') as file:
+        text = text_format(file.readline())
+    with open(path, 'rb') as file:
+        if text == 'fasta':
+            return sum(line.startswith(b'>') for line in file)
+        count = sum(1 for line in file if line.strip())
+        return max(count - 1, 0) if text == 'csv' else count
+
+
+def chunks(records, chunk_size=CHUNK_SIZE):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Label -> integer, decided once per distinct label (not per row): the trailing number of the label
+# if it has one that no other label has taken, the next unused number otherwise, so two labels never
+# share a code
+def label_code(label, label_map):
+    if label not in label_map:
+        match = LABEL_NUMBER.search(label)
+        code = int(match.group(1)) if match else None
+        if code is None or code in label_map.values():
+            code = max(label_map.values(), default=0) + 1
+        label_map[label] = code
+    return label_map[label]
+
+
+# Runs in a worker: featurizes one chunk and writes it straight into the memory-mapped output
+def featurize_chunk(output, start, seqs, k, ambiguous):
+    features = np.load(output, mmap_mode='r+')
+    features[start:start + len(seqs)] = featurize(seqs, k, ambiguous)
+    features.flush()
+    return len(seqs)
+
+
+# Runs in a worker: like featurize_chunk, for the sequences start .. stop - 1 of a sequence store, which
+# the worker reads from the memory-mapped file instead of receiving them from the parent process
+def featurize_store_chunk(path, output, start, stop, k, ambiguous):
+    store = SequenceStore(path)
+    return featurize_chunk(output, start, [store[index] for index in range(start, stop)], k, ambiguous)
+
+
+# Work of every chunk as (function, arguments, (label, sequence) records for the labels)
+def chunk_jobs(path, output, k, ambiguous, chunk_size):
+    if is_store(path):
+        store = SequenceStore(path)
+        for start in range(0, len(store), chunk_size):
+            stop = min(start + chunk_size, len(store))
+            records = [(store.label(index), None) for index in range(start, stop)]
+            yield featurize_store_chunk, (path, output, start, stop, k, ambiguous), records
+    else:
+        start = 0
+        for chunk in chunks(((label, seq) for _, label, seq in read_records(path)), chunk_size):
+            yield featurize_chunk, (output, start, [seq for _, seq in chunk], k, ambiguous), chunk
+            start += len(chunk)
+
+
+# Streams a CSV, FASTA or one sequence per line file (or a sequence store) through featurize in
+# chunks over a process pool into a float32 .npy (records x 4^k) that is written in place through a
+# memory map, so neither the sequences nor the features of the whole file are ever in memory. Returns
+# the features (memory-mapped), the int32 labels (None for unlabeled files) and the label map.
+def featurize_file(path, output, k=2, ambiguous='skip', processes=None, chunk_size=CHUNK_SIZE, label_map=None):
+    rows = count_records(path)
+    np.lib.format.open_memmap(output, mode='w+', dtype=np.float32, shape=(rows, 4 ** k)).flush()
+    label_map = {} if label_map is None else dict(label_map)
+    labels = np.zeros(rows, dtype=np.int32)
+    labeled = False
+
+    start = 0
+    if processes == 1:
+        for function, job, chunk in chunk_jobs(path, output, k, ambiguous, chunk_size):
+            function(*job)
+            labeled = store_labels(labels, start, chunk, label_map) or labeled
+            start += len(chunk)
+    else:
+        max_pending = 2 * (processes or os.cpu_count() or 1)
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            pending = set()
+            for function, job, chunk in chunk_jobs(path, output, k, ambiguous, chunk_size):
+                pending.add(executor.submit(function, *job))
+                labeled = store_labels(labels, start, chunk, label_map) or labeled
+                start += len(chunk)
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+            for future in pending:
+                future.result()
+
+    if start != rows:
+        raise ValueError(f'{path}: counted {rows} records but read {start}')
+    return np.load(output, mmap_mode='r'), labels if labeled else None, label_map
+
+
+def store_labels(labels, start, chunk, label_map):
+    if chunk[0][0] is None:
+        return False
+    labels[start:start + len(chunk)] = [label_code(label, label_map) for label, _ in chunk]
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help='CSV (Type, Sequence), FASTA or sequence store file')
+    parser.add_argument('output', help='.npy file for the float32 feature matrix')
+    parser.add_argument('-k', type=int, default=2)
+    parser.add_argument('--ambiguous', choices=AMBIGUOUS_POLICIES, default='skip')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--labels', help='.npy file for the int32 labels')
+    parser.add_argument('--label-map', help='JSON label map to reuse (and update), e.g. the one of the training set')
+    args = parser.parse_args()
+
+    label_map = None
+    if args.label_map and os.path.exists(args.label_map):
+        with open(args.label_map) as file:
+            label_map = json.load(file)
+
+    features, labels, label_map = featurize_file(args.input, args.output, args.k, args.ambiguous, args.processes,
+                                                 args.chunk_size, label_map)
+    if args.labels and labels is not None:
+        np.save(args.labels, labels)
+    if args.label_map:
+        with open(args.label_map, 'w') as file:
+            json.dump(label_map, file, indent=1)
+    print(f'{features.shape[0]} sequences x {features.shape[1]} features -> {args.output}', file=sys.stderr)
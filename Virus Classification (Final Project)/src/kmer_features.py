@@ -0,0 +1,160 @@
+import argparse
+import csv
+import sys
+import time
+
+import numpy as np
+import scipy.sparse
+
+import shared_path
+from seq_store import AMBIGUOUS, CODES
+
+ALPHABET = 'ACGT'
+# What to do with a base outside ACGT (N and the other IUPAC codes):
+#   'skip'  - windows containing it are not counted, frequencies are over the remaining windows
+#   'error' - raise ValueError (kmer_for_one_sequence failed with a KeyError)
+AMBIGUOUS_POLICIES = ('skip', 'error')
+# Largest k whose k-mer indexes fit in 64 bits at 2 bits per base
+MAX_K = 31
+
+
+def encode(seq):
+    return CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+
+def kmer_names(k):
+    return [''.join(ALPHABET[(index >> 2 * (k - 1 - t)) & 3] for t in range(k)) for index in range(4 ** k)]
+
+
+# Index of the k-mer starting at every position of codes (base 4, first base most significant,
+# the order of itertools.product(ALPHABET, repeat=k)) and whether all of its bases are ACGT.
+# Built with k shifted adds over the whole array instead of one slice per window.
+def kmer_indexes(codes, k):
+    windows = len(codes) - k + 1
+    if windows <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+
+    ambiguous = codes == AMBIGUOUS
+    values = np.where(ambiguous, 0, codes).astype(np.int64)
+    indexes = np.zeros(windows, dtype=np.int64)
+    bad = np.zeros(windows, dtype=bool)
+    for t in range(k):
+        indexes <<= 2
+        indexes |= values[t:t + windows]
+        bad |= ambiguous[t:t + windows]
+    return indexes, ~bad
+
+
+# Normalized k-mer counts of every sequence as a dense (sequences x 4^k) float32 matrix, in the
+# feature order of kmer_for_one_sequence. All sequences go through one encode and one bincount.
+def featurize(seqs, k, ambiguous='skip'):
+    seqs = list(seqs)
+    size = 4 ** k
+    codes, owners = encode_all(seqs, ambiguous)
+
+    indexes, valid = kmer_indexes(codes, k)
+    owners = owners[:len(indexes)]
+    counts = np.bincount(owners[valid] * size + indexes[valid], minlength=len(seqs) * size)
+    counts = counts.reshape(len(seqs), size).astype(np.float32)
+
+    windows = counts.sum(axis=1, keepdims=True)
+    np.divide(counts, windows, out=counts, where=windows > 0)
+    return counts
+
+
+# Normalized k-mer counts for several k at once as a sparse CSR float32 matrix: the 4^k columns of
+# every k in ks side by side (in the order of ks), with only the k-mers that occur stored, so memory
+# follows the k-mers present rather than 4^k. Every k block is normalized over its own windows, so it
+# equals featurize(seqs, k). The indexes of k + 1 are extended from those of k in the same pass.
+def featurize_sparse(seqs, ks, ambiguous='skip'):
+    seqs = list(seqs)
+    ks = [ks] if isinstance(ks, int) else list(ks)
+    if not ks or min(ks) < 1 or max(ks) > MAX_K:
+        raise ValueError(f'k must be between 1 and {MAX_K}')
+    codes, owners = encode_all(seqs, ambiguous)
+
+    offsets = np.concatenate([[0], np.cumsum([4 ** k for k in ks])])
+    rows, columns, windows = [], [], np.zeros((len(ks), len(seqs)))
+    ambiguous_codes = codes == AMBIGUOUS
+    values = np.where(ambiguous_codes, 0, codes).astype(np.int64)
+    indexes = values
+    bad = ambiguous_codes
+    for k in range(1, max(ks) + 1):
+        if k > 1:
+            indexes = (indexes[:-1] << 2) | values[k - 1:]
+            bad = bad[:-1] | ambiguous_codes[k - 1:]
+        for block in [block for block, block_k in enumerate(ks) if block_k == k]:
+            valid = ~bad
+            block_rows = owners[:len(indexes)][valid]
+            rows.append(block_rows)
+            columns.append(indexes[valid] + offsets[block])
+            windows[block] = np.bincount(block_rows, minlength=len(seqs))
+
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.intp)
+    columns = np.concatenate(columns) if columns else np.zeros(0, dtype=np.int64)
+    # Duplicate (row, column) pairs are summed when the matrix is built
+    features = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                                       shape=(len(seqs), int(offsets[-1])))
+
+    entry_rows = np.repeat(np.arange(len(seqs)), np.diff(features.indptr))
+    entry_blocks = np.searchsorted(offsets, features.indices, side='right') - 1
+    features.data /= windows[entry_blocks, entry_rows].astype(np.float32)
+    return features
+
+
+# All sequences as one array of codes, separated by an ambiguous base so that no window spans two
+# sequences, and the index of the sequence every position belongs to
+def encode_all(seqs, ambiguous):
+    if ambiguous not in AMBIGUOUS_POLICIES:
+        raise ValueError(f'ambiguous must be one of {AMBIGUOUS_POLICIES}')
+
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    codes = encode(''.join(seq + 'N' for seq in seqs))
+    if ambiguous == 'error':
+        check_ambiguous(codes, lengths, seqs)
+    return codes, np.repeat(np.arange(len(seqs)), lengths + 1)
+
+
+def check_ambiguous(codes, lengths, seqs):
+    ends = np.cumsum(lengths + 1) - 1
+    positions = np.flatnonzero(codes == AMBIGUOUS)
+    positions = positions[~np.isin(positions, ends)]
+    if len(positions):
+        index = int(np.searchsorted(ends, positions[0]))
+        offset = int(positions[0] - (ends[index] - lengths[index]))
+        raise ValueError(f'sequence {index} has {seqs[index][offset]!r} at position {offset}')
+
+
+def featurize_one(seq, k, ambiguous='skip'):
+    return featurize([seq], k, ambiguous)[0]
+
+
+# Labels and sequences of a dataset CSV with the columns Type (optional) and Sequence
+def read_csv(path):
+    with open(path, newline='') as file:
+        rows = list(csv.DictReader(file))
+    return [row.get('Type') for row in rows], [row['Sequence'] for row in rows]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('csv', help='dataset with a Sequence (and optionally a Type) column')
+    parser.add_argument('-k', type=int, nargs='+', default=[2], help='one k, or several for sparse features')
+    parser.add_argument('--ambiguous', choices=AMBIGUOUS_POLICIES, default='skip')
+    parser.add_argument('--sparse', action='store_true', help='sparse CSR features (implied by several k)')
+    parser.add_argument('--output', help='save the feature matrix as .npy (.npz when sparse)')
+    args = parser.parse_args()
+
+    _, seqs = read_csv(args.csv)
+    sparse = args.sparse or len(args.k) > 1
+    start = time.perf_counter()
+    if sparse:
+        features = featurize_sparse(seqs, args.k, args.ambiguous)
+    else:
+        features = featurize(seqs, args.k[0], args.ambiguous)
+    elapsed = time.perf_counter() - start
+    if args.output and sparse:
+        scipy.sparse.save_npz(args.output, features)
+    elif args.output:
+        np.save(args.output, features)
+    print(f'{features.shape[0]} sequences x {features.shape[1]} features in {elapsed:.3f}s', file=sys.stderr)
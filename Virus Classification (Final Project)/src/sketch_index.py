@@ -0,0 +1,158 @@
+import argparse
+import json
+import struct
+import sys
+import time
+
+import numpy as np
+
+from kmer_features import MAX_K, encode, kmer_indexes
+
+import shared_path
+from seq_store import read_records
+
+SKETCH_K = 16
+# Bins per sketch, a power of two; the Jaccard estimate has a standard error of about 1 / sqrt(SKETCH_SIZE)
+SKETCH_SIZE = 256
+SEED = 42
+TOP_HITS = 5
+EMPTY = np.uint32(0xFFFFFFFF)
+INDEX_MAGIC = b'MHSK'
+INDEX_HEADER = '<IIIQQ'
+
+
+# splitmix64 finalizer over uint64 arrays (multiplications wrap around like in C)
+def mix64(values):
+    values = values ^ (values >> np.uint64(30))
+    values *= np.uint64(0xBF58476D1CE4E5B9)
+    values ^= values >> np.uint64(27)
+    values *= np.uint64(0x94D049BB133111EB)
+    values ^= values >> np.uint64(31)
+    return values
+
+
+def check_parameters(k, size):
+    if k < 1 or k > MAX_K:
+        raise ValueError(f'k must be between 1 and {MAX_K}')
+    if size < 1 or size & (size - 1):
+        raise ValueError('size must be a power of two')
+
+
+# One-permutation MinHash of the k-mers of seq: every k-mer is hashed once, the top bits of the hash
+# choose one of size bins and each bin keeps the smallest of the remaining bits (EMPTY when no k-mer
+# fell into it). Windows with ambiguous bases are left out.
+def sketch(seq, k=SKETCH_K, size=SKETCH_SIZE, seed=SEED):
+    check_parameters(k, size)
+    indexes, valid = kmer_indexes(encode(seq), k)
+    with np.errstate(over='ignore'):
+        hashes = mix64(indexes[valid].astype(np.uint64) ^ mix64(np.array([seed], dtype=np.uint64)))
+
+    bin_bits = size.bit_length() - 1
+    bins = (hashes >> np.uint64(64 - bin_bits)).astype(np.intp) if bin_bits else np.zeros(len(hashes), np.intp)
+    values = (hashes & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+    result = np.full(size, EMPTY, dtype=np.uint32)
+    np.minimum.at(result, bins, values)
+    return result
+
+
+# Estimated Jaccard similarity of one sketch against every row of sketches: equal bins over the
+# bins that are filled in at least one of the two
+def similarities(sketches, query):
+    filled = query != EMPTY
+    matches = ((sketches == query) & filled).sum(axis=1)
+    union = ((sketches != EMPTY) | filled).sum(axis=1)
+    return np.divide(matches, union, out=np.zeros(len(sketches)), where=union > 0)
+
+
+# MinHash sketches of reference sequences with their names and labels, searchable by estimated
+# Jaccard similarity. Saved as one file (header, uint32 sketches, JSON names and labels) whose
+# sketch matrix is memory-mapped on load.
+class SketchIndex:
+    def __init__(self, sketches, names, labels, k=SKETCH_K, seed=SEED):
+        self.sketches = sketches
+        self.names = names
+        self.labels = labels
+        self.k = k
+        self.seed = seed
+
+    @classmethod
+    def build(cls, records, k=SKETCH_K, size=SKETCH_SIZE, seed=SEED):
+        check_parameters(k, size)
+        sketches, names, labels = [], [], []
+        for name, label, seq in records:
+            sketches.append(sketch(seq, k, size, seed))
+            names.append(name)
+            labels.append(label)
+        sketches = np.array(sketches, dtype=np.uint32).reshape(len(sketches), size)
+        return cls(sketches, names, labels, k, seed)
+
+    def __len__(self):
+        return len(self.sketches)
+
+    @property
+    def size(self):
+        return self.sketches.shape[1]
+
+    # Top hits of a sequence as (name, label, estimated Jaccard), most similar first
+    def query(self, seq, top=TOP_HITS):
+        scores = similarities(self.sketches, sketch(seq, self.k, self.size, self.seed))
+        top = min(top, len(scores))
+        best = np.argpartition(-scores, top - 1)[:top] if top else np.zeros(0, dtype=np.intp)
+        best = best[np.lexsort((best, -scores[best]))]
+        return [(self.names[i], self.labels[i], float(scores[i])) for i in best]
+
+    def save(self, path):
+        metadata = json.dumps({'names': self.names, 'labels': self.labels}).encode()
+        header = struct.pack(INDEX_HEADER, self.k, self.size, len(self), self.seed, len(metadata))
+        with open(path, 'wb') as file:
+            file.write(INDEX_MAGIC + header)
+            file.write(self.sketches.astype('<u4').tobytes())
+            file.write(metadata)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            if file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError(f'{path} is not a sketch index')
+            k, size, count, seed, metadata_size = struct.unpack(INDEX_HEADER, file.read(struct.calcsize(INDEX_HEADER)))
+            offset = len(INDEX_MAGIC) + struct.calcsize(INDEX_HEADER)
+            file.seek(offset + 4 * size * count)
+            metadata = json.loads(file.read(metadata_size))
+
+        sketches = np.memmap(path, dtype='<u4', mode='r', offset=offset, shape=(count, size)) if count else \
+            np.zeros((0, size), dtype=np.uint32)
+        return cls(sketches, metadata['names'], metadata['labels'], k, seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='sketch the reference sequences of a CSV/FASTA file')
+    build.add_argument('input')
+    build.add_argument('index')
+    build.add_argument('-k', type=int, default=SKETCH_K)
+    build.add_argument('--size', type=int, default=SKETCH_SIZE, help='bins per sketch (a power of two)')
+    build.add_argument('--seed', type=int, default=SEED)
+    query = commands.add_parser('query', help='nearest references of every sequence of a CSV/FASTA file')
+    query.add_argument('index')
+    query.add_argument('input')
+    query.add_argument('--top', type=int, default=TOP_HITS)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.k < 1 or args.k > MAX_K:
+            parser.error(f'-k must be between 1 and {MAX_K}')
+        if args.size < 1 or args.size & (args.size - 1):
+            parser.error('--size must be a power of two')
+        index = SketchIndex.build(read_records(args.input), args.k, args.size, args.seed)
+        index.save(args.index)
+        print(f'{len(index)} sketches of {index.size} bins (k={index.k}) -> {args.index}', file=sys.stderr)
+    else:
+        index = SketchIndex.load(args.index)
+        start = time.perf_counter()
+        count = 0
+        for name, _, seq in read_records(args.input):
+            hits = index.query(seq, args.top)
+            print(name + '\t' + '\t'.join(f'{hit_name}:{hit_label}:{score:.3f}' for hit_name, hit_label, score in hits))
+            count += 1
+        print(f'{count} queries in {time.perf_counter() - start:.3f}s', file=sys.stderr)
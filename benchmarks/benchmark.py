@@ -0,0 +1,207 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+PROJECT_SOURCES = {
+    'pairwise': '2- Pairwise Sequence Alignment/src',
+    'msa': '3- Multiple Sequence Alignment - DB Search/src',
+    'profile': '4- Profile - Hidden Markov model/src',
+    'virus': 'Virus Classification (Final Project)/src',
+}
+DNA = 'ACGT'
+PROTEIN = 'ACDEFGHIKLMNPQRSTVWY'
+SEED = 7
+REPEATS = 3
+# A case regresses when its time or peak memory grows by more than this fraction over the baseline
+THRESHOLD = 0.25
+# Times below this many seconds, and peak memory below this many bytes, are too noisy to compare
+MIN_SECONDS = 0.005
+MIN_BYTES = 1 << 20
+
+
+def load(project, module):
+    source = os.path.normpath(os.path.join(ROOT, PROJECT_SOURCES[project]))
+    if source not in sys.path:
+        sys.path.insert(0, source)
+    return importlib.import_module(module)
+
+
+def random_seq(rng, length, alphabet=DNA):
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+# seq with about rate substitutions, insertions and deletions per residue, in equal parts
+def mutate(rng, seq, rate, alphabet=DNA):
+    result = []
+    for char in seq:
+        roll = rng.random()
+        if roll < rate / 3:
+            result.append(rng.choice(alphabet))
+        elif roll < 2 * rate / 3:
+            result.append(char + rng.choice(alphabet))
+        elif roll >= rate:
+            result.append(char)
+    return ''.join(result)
+
+
+def family(rng, count, length, rate=0.1, alphabet=DNA):
+    ancestor = random_seq(rng, length, alphabet)
+    return [mutate(rng, ancestor, rate, alphabet) for _ in range(count)]
+
+
+# Every case maps its sizes to a setup function that returns the call to measure; the setup itself
+# (inputs, and for the traceback the filled matrices) is not measured.
+
+def semi_global_fill(rng, size):
+    module = load('pairwise', 'semi_global_alignment')
+    str1, str2 = family(rng, 2, size, 0.2, PROTEIN)
+
+    def run():
+        module.str1, module.str2 = str1, str2
+        module.score_matrix, module.direction_matrix = [], []
+        module.total_score, module.total_locations = 0, []
+        module.init_and_fill_matrix()
+    return run
+
+
+def semi_global_trace_back(rng, size):
+    module = load('pairwise', 'semi_global_alignment')
+    semi_global_fill(rng, size)()
+    module.find_total_score_locations()
+    return lambda: list(module.semi_global_alignment(100))
+
+
+def global_align(rng, size):
+    module = load('msa', 'main')
+    x, y = family(rng, 2, size, 0.2)
+    return lambda: module.global_align(x, y, module.S_MATCH, module.S_MISSMATCH, module.S_GAP)
+
+
+def star_alignment(rng, size):
+    module = load('msa', 'main')
+    refinement = load('msa', 'refinement')
+    seqs = family(rng, size, 60)
+
+    # The full main.py run: center, star alignment and refinement until no block improves
+    def run():
+        module.cached_global_align.cache_clear()
+        score_matrix, center_seq = module.fill_matrix_and_find_center(seqs, processes=1)
+        aligned_seqs = module.star_alignment(center_seq, score_matrix, seqs)
+        refinement.refine_alignment(aligned_seqs, None, None, processes=1)
+    return run
+
+
+def profile_search(rng, size):
+    module = load('profile', 'Profile')
+    # Aligned rows (equal length, a few gaps), as Profile.py takes them
+    seqs = [''.join('-' if rng.random() < 0.1 else char for char in seq) for seq in family(rng, 8, 40, 0.0)]
+    query = random_seq(rng, size)
+
+    def run():
+        profile = module.Profile.from_alignment(seqs)
+        module.search_profile(profile, query)
+    return run
+
+
+def kmer_features(rng, size):
+    module = load('virus', 'kmer_features')
+    seqs = [random_seq(rng, 1000) for _ in range(size)]
+    return lambda: module.featurize(seqs, 4)
+
+
+CASES = {
+    'semi_global_fill': (semi_global_fill, [50, 100, 200]),
+    'semi_global_trace_back': (semi_global_trace_back, [50, 100, 200]),
+    'global_align': (global_align, [100, 200, 400]),
+    'star_alignment': (star_alignment, [4, 8, 16, 32]),
+    'profile_search': (profile_search, [100, 1000, 10000]),
+    'kmer_features': (kmer_features, [100, 1000, 10000]),
+}
+
+
+# Best wall time of repeats calls, and the peak memory Python and NumPy allocate in one more call
+# (traced separately, since tracing slows allocations down)
+def measure(run, repeats=REPEATS):
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(seconds), peak
+
+
+def run_benchmarks(cases=None, repeats=REPEATS, scale=1.0):
+    results = []
+    for name in cases or CASES:
+        setup, sizes = CASES[name]
+        # Small scales can round several sizes to the same one, which is then run once
+        for size in dict.fromkeys(max(1, int(size * scale)) for size in sizes):
+            seconds, peak = measure(setup(random.Random(SEED), size), repeats)
+            results.append({'case': name, 'size': size, 'seconds': seconds, 'peak_bytes': peak})
+            print(f'{name:24} {size:>7} {seconds:10.4f}s {peak / 2 ** 20:10.2f} MiB', file=sys.stderr, flush=True)
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+# Cases of run whose time or peak memory grew by more than threshold over the same case and size
+# in baseline, as (case, size, metric, baseline value, new value)
+def regressions(run, baseline, threshold=THRESHOLD):
+    previous = {(result['case'], result['size']): result for result in baseline['results']}
+    found = []
+    for result in run['results']:
+        before = previous.get((result['case'], result['size']))
+        if before is None:
+            continue
+        for metric, floor in (('seconds', MIN_SECONDS), ('peak_bytes', MIN_BYTES)):
+            if before[metric] < floor:
+                continue
+            if result[metric] > before[metric] * (1 + threshold):
+                found.append((result['case'], result['size'], metric, before[metric], result[metric]))
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and peak memory of the course tools over growing inputs')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), help='cases to run (all by default)')
+    parser.add_argument('--repeats', type=int, default=REPEATS, help='timed calls per size, the best one counts')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply every size, e.g. 0.25 for a quick run')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--baseline', help='JSON of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='allowed growth over the baseline, as a fraction')
+    args = parser.parse_args()
+
+    run = run_benchmarks(args.cases, args.repeats, args.scale)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(run, file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(run, json.load(file), args.threshold)
+        for case, size, metric, before, after in found:
+            print(f'REGRESSION {case} size {size}: {metric} {before:.4g} -> {after:.4g} ({after / before:.2f}x)')
+        if found:
+            sys.exit(1)
+        print(f'no regressions over {args.threshold:.0%}')
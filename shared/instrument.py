@@ -0,0 +1,88 @@
+import contextlib
+import json
+import os
+import sys
+import time
+
+# Opt-in run statistics for the command-line tools. Nothing is recorded until enable() is called:
+# stage() then hands out a shared no-op context and count() returns after one check, so code can stay
+# instrumented at almost no cost. Counters only cover work done in this process.
+enabled = False
+started = 0.0
+counters = {}
+stages = {}
+values = {}
+
+
+def enable():
+    global enabled, started
+    enabled = True
+    started = time.perf_counter()
+
+
+# Adds amount to a counter (DP cells, alignments, ...)
+def count(name, amount=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + amount
+
+
+# Stores a value of the run as it is, e.g. the score after every refinement round
+def record(name, value):
+    if enabled:
+        values[name] = value
+
+
+# Times a stage of the run. Every call adds its wall time to the stage, together with how much each
+# counter grew meanwhile, so nested stages each get their own share of the counts.
+def stage(name):
+    return timed_stage(name) if enabled else contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def timed_stage(name):
+    before = dict(counters)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        totals = stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        totals['seconds'] += time.perf_counter() - start
+        totals['calls'] += 1
+        for key, total in counters.items():
+            if total != before.get(key, 0):
+                totals[key] = totals.get(key, 0) + total - before.get(key, 0)
+
+
+# The items of iterable, counted into counter name as they are taken
+def counted(iterable, name):
+    if not enabled:
+        return iterable
+    return (count(name) or item for item in iterable)
+
+
+def report():
+    result = {
+        'script': os.path.basename(sys.argv[0]),
+        'wall_seconds': time.perf_counter() - started,
+        'stages': {},
+        'counters': dict(counters),
+        'values': values,
+    }
+    for name, totals in stages.items():
+        totals = dict(totals)
+        if 'cells' in totals and totals['seconds'] > 0:
+            totals['cells_per_second'] = totals['cells'] / totals['seconds']
+        result['stages'][name] = totals
+    return result
+
+
+# Writes the report as one line of JSON to path, or to stderr for '-'
+def emit(path='-'):
+    if not enabled:
+        return
+    line = json.dumps(report()) + '\n'
+    if path == '-':
+        sys.stderr.write(line)
+    else:
+        with open(path, 'a') as file:
+            file.write(line)
@@ -0,0 +1,284 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+STORE_MAGIC = b'SEQS'
+# version, kind, sequences, residues, exceptions, lowercase runs, metadata bytes
+STORE_HEADER = '<IIQQQQQ'
+STORE_VERSION = 2
+KINDS = ('dna', 'protein')
+ALPHABET = 'ACGT'
+AMBIGUOUS = 255
+SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+
+# 2-bit code of every byte: A=0, C=1, G=2, T=3 (lowercase too), anything else (N, IUPAC codes) AMBIGUOUS.
+# kmer_features encodes sequences with this table too, so stored codes and encoded text always agree.
+CODES = np.full(256, AMBIGUOUS, dtype=np.uint8)
+CODES[np.frombuffer(ALPHABET.encode(), dtype=np.uint8)] = np.arange(len(ALPHABET))
+CODES[np.frombuffer(ALPHABET.lower().encode(), dtype=np.uint8)] = np.arange(len(ALPHABET))
+LETTERS = np.frombuffer(ALPHABET.encode(), dtype=np.uint8)
+# Adding CASE to an uppercase ASCII letter makes it lowercase
+CASE = ord('a') - ord('A')
+
+csv.field_size_limit(sys.maxsize)
+
+
+def is_store(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as file:
+        return file.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+
+def padding(size):
+    return -size % 8
+
+
+# Sequences in one file that is opened through memory maps, so reading a sequence copies only that
+# sequence and every process that opens the file shares one copy of it in the page cache:
+#   header | int64 offsets (sequences + 1) | residues | int64 exception positions | exception bytes |
+#   int64 lowercase run starts | int64 lowercase run stops | JSON
+# DNA residues are packed 2 bits per base, 4 bases per byte with the first in the high bits, case
+# folded; every residue outside ACGT/acgt is packed as A and listed as an exception (position and
+# uppercase byte), and lowercase letters (soft-masked regions) are kept as runs [start, stop), so
+# sequences come back exactly as imported. Protein residues are stored as one byte each.
+# Names and labels are in the JSON metadata, which is only parsed when they are asked for.
+class SequenceStore:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            if file.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                raise ValueError(f'{path} is not a sequence store')
+            version, kind, count, residues, exceptions, runs, metadata_size = struct.unpack(
+                STORE_HEADER, file.read(struct.calcsize(STORE_HEADER)))
+        if version != STORE_VERSION:
+            raise ValueError(f'{path} is a version {version} sequence store, expected {STORE_VERSION}')
+
+        self.kind = KINDS[kind]
+        data_size = (residues + 3) // 4 if self.kind == 'dna' else residues
+        offset = len(STORE_MAGIC) + struct.calcsize(STORE_HEADER)
+        offset += padding(offset)
+        self.offsets = self.section(offset, np.int64, count + 1)
+        offset += 8 * (count + 1)
+        self.data = self.section(offset, np.uint8, data_size)
+        offset += data_size + padding(data_size)
+        self.exception_positions = self.section(offset, np.int64, exceptions)
+        offset += 8 * exceptions
+        self.exception_bytes = self.section(offset, np.uint8, exceptions)
+        offset += exceptions + padding(exceptions)
+        self.lower_starts = self.section(offset, np.int64, runs)
+        offset += 8 * runs
+        self.lower_stops = self.section(offset, np.int64, runs)
+        self.metadata_offset, self.metadata_size = offset + 8 * runs, metadata_size
+        self._metadata = None
+        self._index = None
+
+    def section(self, offset, dtype, count):
+        if not count:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+    # Writes the records, (name, label, sequence) with label None when there is none, to path.
+    # Residues are streamed to a temporary file, so the sequences are never all in memory.
+    @classmethod
+    def write(cls, path, records, kind='dna'):
+        if kind not in KINDS:
+            raise ValueError(f'kind must be one of {KINDS}')
+        offsets, names, labels = [0], [], []
+        positions, exception_bytes, lower_starts, lower_stops = [], [], [], []
+        carry = np.zeros(0, dtype=np.uint8)
+
+        with tempfile.TemporaryFile() as data:
+            for name, label, seq in records:
+                residues = np.frombuffer(seq.encode(), dtype=np.uint8)
+                if kind == 'dna':
+                    lower = (residues >= ord('a')) & (residues <= ord('z'))
+                    edges = np.flatnonzero(np.diff(np.concatenate([[False], lower, [False]]).view(np.int8)))
+                    lower_starts.append(offsets[-1] + edges[0::2])
+                    lower_stops.append(offsets[-1] + edges[1::2])
+                    codes = CODES[residues]
+                    ambiguous = np.flatnonzero(codes == AMBIGUOUS)
+                    positions.append(offsets[-1] + ambiguous)
+                    exception_bytes.append(residues[ambiguous] - lower[ambiguous] * np.uint8(CASE))
+                    codes[ambiguous] = 0
+                    codes = np.concatenate([carry, codes])
+                    whole = len(codes) - len(codes) % 4
+                    data.write(pack(codes[:whole]).tobytes())
+                    carry = codes[whole:]
+                else:
+                    data.write(residues.tobytes())
+                offsets.append(offsets[-1] + len(residues))
+                names.append(name)
+                labels.append(label)
+            if len(carry):
+                data.write(pack(np.concatenate([carry, np.zeros(4 - len(carry), dtype=np.uint8)])).tobytes())
+
+            positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+            exception_bytes = np.concatenate(exception_bytes) if exception_bytes else np.zeros(0, dtype=np.uint8)
+            lower_starts = np.concatenate(lower_starts) if lower_starts else np.zeros(0, dtype=np.int64)
+            lower_stops = np.concatenate(lower_stops) if lower_stops else np.zeros(0, dtype=np.int64)
+            metadata = json.dumps({'names': names, 'labels': labels}).encode()
+            header = STORE_MAGIC + struct.pack(STORE_HEADER, STORE_VERSION, KINDS.index(kind), len(names),
+                                               offsets[-1], len(positions), len(lower_starts), len(metadata))
+
+            with open(path, 'wb') as file:
+                file.write(header + bytes(padding(len(header))))
+                file.write(np.array(offsets, dtype='<i8').tobytes())
+                data.seek(0)
+                shutil.copyfileobj(data, file)
+                file.write(bytes(padding(data.tell())))
+                file.write(positions.astype('<i8').tobytes())
+                file.write(exception_bytes.tobytes() + bytes(padding(len(exception_bytes))))
+                file.write(lower_starts.astype('<i8').tobytes())
+                file.write(lower_stops.astype('<i8').tobytes())
+                file.write(metadata)
+        return cls(path)
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            with open(self.path, 'rb') as file:
+                file.seek(self.metadata_offset)
+                self._metadata = json.loads(file.read(self.metadata_size))
+        return self._metadata
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def name(self, index):
+        return self.metadata['names'][index]
+
+    def label(self, index):
+        return self.metadata['labels'][index]
+
+    # Index of the sequence with the given name (the first one if names repeat)
+    def find(self, name):
+        if self._index is None:
+            self._index = {}
+            for index, seq_name in enumerate(self.metadata['names']):
+                self._index.setdefault(seq_name, index)
+        return self._index[name]
+
+    # Residue bytes of a sequence (for protein a view of the file, not a copy)
+    def residues(self, index):
+        start, stop = int(self.offsets[index]), int(self.offsets[index + 1])
+        if self.kind == 'protein':
+            return self.data[start:stop]
+        residues = LETTERS[self.unpack(start, stop)]
+        first, last = np.searchsorted(self.exception_positions, [start, stop])
+        residues[self.exception_positions[first:last] - start] = self.exception_bytes[first:last]
+
+        # Lowercase runs overlapping the sequence, marked as +1/-1 steps and summed into a mask
+        first, last = np.searchsorted(self.lower_stops, start, 'right'), np.searchsorted(self.lower_starts, stop)
+        steps = np.zeros(stop - start + 1, dtype=np.int64)
+        np.add.at(steps, np.maximum(self.lower_starts[first:last], start) - start, 1)
+        np.add.at(steps, np.minimum(self.lower_stops[first:last], stop) - start, -1)
+        residues[np.cumsum(steps[:-1]) > 0] += CASE
+        return residues
+
+    # 2-bit codes of a DNA sequence, AMBIGUOUS at the exceptions (the codes kmer_features uses)
+    def codes(self, index):
+        if self.kind != 'dna':
+            raise ValueError('2-bit codes are only stored for DNA')
+        start, stop = int(self.offsets[index]), int(self.offsets[index + 1])
+        codes = self.unpack(start, stop)
+        first, last = np.searchsorted(self.exception_positions, [start, stop])
+        codes[self.exception_positions[first:last] - start] = AMBIGUOUS
+        return codes
+
+    def unpack(self, start, stop):
+        packed = self.data[start // 4:(stop + 3) // 4]
+        codes = ((packed[:, np.newaxis] >> SHIFTS) & 3).ravel()
+        return codes[start % 4:start % 4 + stop - start]
+
+    def __getitem__(self, index):
+        return self.residues(index).tobytes().decode()
+
+    # (name, label, sequence) of every sequence in order
+    def records(self):
+        names, labels = self.metadata['names'], self.metadata['labels']
+        for index in range(len(self)):
+            yield names[index], labels[index], self[index]
+
+
+# 4 codes per byte, the first in the high bits
+def pack(codes):
+    return np.bitwise_or.reduce(codes.reshape(-1, 4) << SHIFTS, axis=1).astype(np.uint8)
+
+
+# Format of a text file by its first line: 'fasta', 'csv' (a header with a Sequence column) or 'lines'
+def text_format(first_line):
+    if first_line.startswith('>'):
+        return 'fasta'
+    return 'csv' if 'Sequence' in next(csv.reader([first_line]), []) else 'lines'
+
+
+# (name, label, sequence) records of lines of text, by the first line: FASTA (named by the first word
+# of the header), CSV with a Sequence and optionally a Type column, or one sequence per line. Only CSV
+# records have labels (None otherwise), and CSV and plain records are named by their number.
+def parse_records(lines):
+    lines = iter(lines)
+    first = next(lines, '')
+    text = text_format(first)
+    lines = itertools.chain([first], lines)
+
+    if text == 'fasta':
+        name, parts = None, []
+        for line in lines:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, None, ''.join(parts)
+                name, parts = (line[1:].split() or [''])[0], []
+            elif line:
+                parts.append(line)
+        if name is not None:
+            yield name, None, ''.join(parts)
+    elif text == 'csv':
+        for number, row in enumerate(csv.DictReader(lines)):
+            yield str(number), row.get('Type'), row['Sequence']
+    else:
+        for number, seq in enumerate(line.strip() for line in lines if line.strip()):
+            yield str(number), None, seq
+
+
+# Records of a sequence store, or of a text file as parse_records reads it
+def read_records(path):
+    if is_store(path):
+        yield from SequenceStore(path).records()
+    else:
+        with open(path, newline='') as file:
+            yield from parse_records(file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory-mapped sequence store')
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='convert a FASTA, CSV (Type, Sequence) or one sequence per line '
+                                                       'file to a store')
+    import_parser.add_argument('input')
+    import_parser.add_argument('store')
+    import_parser.add_argument('--kind', choices=KINDS, default='dna')
+    get_parser = commands.add_parser('get', help='print sequences of a store as FASTA')
+    get_parser.add_argument('store')
+    get_parser.add_argument('names', nargs='*', help='names of the sequences (all of them by default)')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        store = SequenceStore.write(args.store, read_records(args.input), args.kind)
+        print(f'{len(store)} sequences, {int(store.offsets[-1])} residues ({store.kind}), '
+              f'{os.path.getsize(args.store)} bytes -> {args.store}', file=sys.stderr)
+    else:
+        store = SequenceStore(args.store)
+        indexes = [store.find(name) for name in args.names] if args.names else range(len(store))
+        for index in indexes:
+            print(f'>{store.name(index)}')
+            print(store[index])